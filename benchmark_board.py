@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of the board primitives that dominate self-play and search
+time, across board sizes and game phases, for one or more Board
+implementations side by side
+
+Usage: python benchmark_board.py [--impl game.Board game.BitBoard]
+                                 [--repeat 2000] [--sizes 6x6x4 8x8x5]
+"""
+
+from __future__ import print_function
+import argparse
+import copy
+import importlib
+import random
+import time
+import tracemalloc
+import numpy as np
+
+SIZES = ['6x6x4', '8x8x5', '15x15x5', '19x19x5']
+# fraction of the board covered by pieces in each game phase
+PHASES = [('early', 0.1), ('mid', 0.35), ('late', 0.65)]
+
+
+def load_impl(name):
+    """Return the class named like 'module.Class'"""
+    module, cls = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), cls)
+
+
+def make_position(board_cls, width, height, n_in_row, density, seed):
+    """Return a board with random moves played up to the given density,
+    without ending the game
+    """
+    rng = random.Random(seed)
+    board = board_cls(width=width, height=height, n_in_row=n_in_row)
+    board.init_board()
+    n_moves = int(density * width * height)
+    while len(board.states) < n_moves:
+        move = rng.choice(board.availables)
+        board.do_move(move)
+        if board.game_end()[0]:
+            board.undo_move()
+            break
+    return board
+
+
+def time_per_call(fn, args_list):
+    """Call fn on each tuple of args_list, return the seconds per call"""
+    start = time.perf_counter()
+    for args in args_list:
+        fn(*args)
+    return (time.perf_counter() - start) / len(args_list)
+
+
+def alloc_per_call(fn, args):
+    """Return the peak bytes allocated by one call of fn"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def bench_position(board, repeat, seed):
+    """Return a list of (op, seconds per call, bytes per call)"""
+    rng = random.Random(seed)
+    moves = [rng.choice(board.availables) for i in range(repeat)]
+    results = []
+
+    # do_move on fresh copies, so that every call does the full work
+    boards = [board.clone() for i in range(repeat)]
+    cost = time_per_call(lambda b, m: b.do_move(m), list(zip(boards, moves)))
+    alloc = alloc_per_call(lambda b, m: b.do_move(m),
+                           (board.clone(), moves[0]))
+    results.append(('do_move', cost, alloc))
+
+    cost = time_per_call(lambda b, m: (b.do_move(m), b.undo_move()),
+                         [(board, m) for m in moves])
+    results.append(('do+undo_move', cost,
+                    alloc_per_call(lambda m: (board.do_move(m),
+                                              board.undo_move()),
+                                   (moves[0],))))
+
+    # game_end right after a move, before the result is cached
+    cost = time_per_call(lambda b: b.game_end(), [(b,) for b in boards])
+    fresh = board.clone()
+    fresh.do_move(moves[0])
+    results.append(('game_end', cost,
+                    alloc_per_call(lambda b: b.game_end(), (fresh,))))
+
+    cost = time_per_call(lambda: board.current_state(), [()] * repeat)
+    results.append(('current_state', cost,
+                    alloc_per_call(lambda: board.current_state(), ())))
+
+    out = np.empty((4, board.height, board.width), dtype=np.float32)
+    cost = time_per_call(lambda: board.current_state(out=out), [()] * repeat)
+    results.append(('current_state(out)', cost,
+                    alloc_per_call(lambda: board.current_state(out=out), ())))
+
+    cost = time_per_call(lambda: board.clone(), [()] * repeat)
+    results.append(('clone', cost, alloc_per_call(lambda: board.clone(), ())))
+
+    n_deepcopy = max(1, repeat // 10)
+    cost = time_per_call(lambda: copy.deepcopy(board), [()] * n_deepcopy)
+    results.append(('deepcopy', cost,
+                    alloc_per_call(lambda: copy.deepcopy(board), ())))
+
+    # how the policy functions consume availables
+    probs = np.ones(board.width * board.height)
+    cost = time_per_call(lambda: probs[board.availables], [()] * repeat)
+    results.append(('availables_index', cost,
+                    alloc_per_call(lambda: probs[board.availables], ())))
+    return results
+
+
+def run(impls, sizes, repeat, seed=0):
+    print('{:<16}{:<8}{:<6}{:<20}{:>14}{:>12}'.format(
+        'impl', 'size', 'phase', 'op', 'ops/sec', 'bytes/op'))
+    for size in sizes:
+        width, height, n_in_row = [int(x) for x in size.split('x')]
+        for phase, density in PHASES:
+            for name in impls:
+                board = make_position(load_impl(name), width, height,
+                                      n_in_row, density, seed)
+                for op, cost, alloc in bench_position(board, repeat, seed):
+                    print('{:<16}{:<8}{:<6}{:<20}{:>14,.0f}{:>12,}'.format(
+                        name.rsplit('.', 1)[1], size, phase, op,
+                        1.0 / cost, alloc))
+            print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--impl', nargs='+',
+                        default=['game.Board', 'game.BitBoard'],
+                        help='board classes to compare, as module.Class')
+    parser.add_argument('--sizes', nargs='+', default=SIZES,
+                        help='board sizes as WIDTHxHEIGHTxN_IN_ROW')
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='calls per measurement')
+    args = parser.parse_args()
+    run(args.impl, args.sizes, args.repeat)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the MCTS engines, independent of any network: the policy is
+a cheap deterministic stand-in so that the numbers reflect the search itself
+
+Usage: python benchmark_mcts.py {tree,select,parallel,threads,rollout}
+                                [--size 8x8x5] [--playouts 400 5000]
+                                [--workers 1 2 4 8] [--threads 1 2 4 8]
+                                [--model best_policy_8_8_5.model]
+                                [--games 10] [--reference 1000]
+"""
+
+from __future__ import print_function
+import argparse
+import pickle
+import time
+import tracemalloc
+import numpy as np
+from game import Board, Game
+from mcts_alphaZero import MCTS, ArrayMCTS, ThreadedMCTS, TreeNode
+from mcts_parallel import RootParallelMCTS
+import mcts_pure
+from policy_value_net_numpy import PolicyValueNetNumpy
+from rollout import random_rollout, heuristic_rollout
+
+
+# fixed random weights of every move, for the stand-in policy
+_WEIGHTS = np.random.RandomState(0).rand(32 * 32)
+
+
+def fake_policy_value_fn(board):
+    """Cheap, reproducible priors and value for each position"""
+    probs = _WEIGHTS[board.availables]
+    probs /= probs.sum()
+    value = (board.zobrist_hash() % 2001) / 1000.0 - 1.0
+    return zip(board.availables, probs), value
+
+
+def fake_policy_value_batch_fn(boards):
+    return [fake_policy_value_fn(board) for board in boards]
+
+
+def make_board(size):
+    width, height, n_in_row = [int(x) for x in size.split('x')]
+    board = Board(width=width, height=height, n_in_row=n_in_row)
+    board.init_board()
+    return board
+
+
+def count_nodes(node):
+    """Number of TreeNode objects in the subtree of node"""
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node._children.values())
+    return count
+
+
+def bench_tree(size, playouts):
+    """Compare the object tree of MCTS and the arrays of ArrayMCTS"""
+    print('{:<10}{:>10}{:>10}{:>14}{:>14}'.format(
+        'tree', 'playouts', 'nodes', 'nodes/sec', 'bytes/node'))
+    for n_playout in playouts:
+        for name, mcts_class in (('object', MCTS), ('array', ArrayMCTS)):
+            mcts = mcts_class(fake_policy_value_fn, 5, n_playout)
+            start = time.perf_counter()
+            mcts.get_move_probs(make_board(size))
+            elapsed = time.perf_counter() - start
+            # build the same tree again with tracing on, for its memory
+            mcts = mcts_class(fake_policy_value_fn, 5, n_playout)
+            tracemalloc.start()
+            mcts.get_move_probs(make_board(size))
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            if isinstance(mcts, ArrayMCTS):
+                n_nodes = mcts.n_nodes()
+            else:
+                n_nodes = count_nodes(mcts._root)
+            print('{:<10}{:>10}{:>10}{:>14,.0f}{:>14,.0f}'.format(
+                name, n_playout, n_nodes, n_nodes / elapsed,
+                float(used) / n_nodes))
+
+
+def scalar_select(node, c_puct):
+    """TreeNode.select as it was before the children stats were stored in
+    arrays: one get_value call per child
+    """
+    return max(node._children.items(),
+               key=lambda act_node: act_node[1].get_value(c_puct))
+
+
+def bench_select(size, playouts):
+    """Compare the vectorized TreeNode.select with per-child scoring"""
+    print('{:<12}{:>10}{:>16}{:>10}'.format(
+        'select', 'playouts', 'playouts/sec', 'speedup'))
+    vectorized_select = TreeNode.select
+    for n_playout in playouts:
+        rates = []
+        for name, select in (('per-child', scalar_select),
+                             ('vectorized', vectorized_select)):
+            TreeNode.select = select
+            try:
+                mcts = MCTS(fake_policy_value_fn, 5, n_playout)
+                start = time.perf_counter()
+                mcts.get_move_probs(make_board(size))
+                rates.append(n_playout / (time.perf_counter() - start))
+            finally:
+                TreeNode.select = vectorized_select
+            print('{:<12}{:>10}{:>16,.0f}{:>10.2f}'.format(
+                name, n_playout, rates[-1], rates[-1] / rates[0]))
+
+
+def bench_parallel(size, playouts, workers):
+    """Scaling of root-parallel search with the number of worker processes,
+    for the AlphaZero search with the stand-in policy and for pure MCTS
+    with rollouts. One worker is the plain single-process search.
+    """
+    print('{:<10}{:>10}{:>10}{:>16}{:>10}'.format(
+        'engine', 'playouts', 'workers', 'playouts/sec', 'speedup'))
+    engines = (('alphazero', MCTS, fake_policy_value_fn),
+               ('pure', mcts_pure.MCTS, mcts_pure.policy_value_fn))
+    for name, mcts_class, policy in engines:
+        for n_playout in playouts:
+            base = None
+            for n_workers in workers:
+                if n_workers > 1:
+                    mcts = RootParallelMCTS(mcts_class, policy, 5, n_playout,
+                                            n_workers)
+                    # the first search also pays for starting the workers
+                    mcts.get_move(make_board(size))
+                else:
+                    mcts = mcts_class(policy, 5, n_playout)
+                start = time.perf_counter()
+                if isinstance(mcts, RootParallelMCTS) or name == 'pure':
+                    mcts.get_move(make_board(size))
+                else:
+                    mcts.get_move_probs(make_board(size))
+                rate = n_playout / (time.perf_counter() - start)
+                if isinstance(mcts, RootParallelMCTS):
+                    mcts.close()
+                base = base or rate
+                print('{:<10}{:>10}{:>10}{:>16,.0f}{:>10.2f}'.format(
+                    name, n_playout, n_workers, rate, rate / base))
+
+
+def bench_threads(size, playouts, threads, model=None):
+    """Compare the threaded shared-tree search with the sequential one,
+    with the numpy network of `model` or the stand-in policy
+    """
+    policy, policy_batch = fake_policy_value_fn, fake_policy_value_batch_fn
+    if model:
+        width, height = [int(x) for x in size.split('x')[:2]]
+        with open(model, 'rb') as f:
+            net = PolicyValueNetNumpy(width, height,
+                                      pickle.load(f, encoding='bytes'))
+        policy, policy_batch = net.policy_value_fn, net.policy_value_batch_fn
+    print('{:<10}{:>10}{:>16}{:>12}{:>14}{:>14}'.format(
+        'threads', 'playouts', 'playouts/sec', 'mean batch',
+        'queue wait ms', 'nodes/sec'))
+    for n_playout in playouts:
+        mcts = MCTS(policy, 5, n_playout)
+        mcts.get_move_probs(make_board(size))
+        info = mcts.last_search
+        print('{:<10}{:>10}{:>16,.0f}{:>12.2f}{:>14.2f}{:>14,.0f}'.format(
+            'seq', n_playout, n_playout / info['time'], 1, 0,
+            mcts.n_nodes() / info['time']))
+        for n_threads in threads:
+            mcts = ThreadedMCTS(policy, 5, n_playout, n_threads, policy_batch)
+            mcts.get_move_probs(make_board(size))
+            info = mcts.last_search
+            print('{:<10}{:>10}{:>16,.0f}{:>12.2f}{:>14.2f}{:>14,.0f}'.format(
+                n_threads, n_playout, n_playout / info['time'],
+                info['mean_batch'], info['queue_wait'] * 1000,
+                info['nodes_per_sec']))
+
+
+def bench_rollout(size, playouts, n_games, reference):
+    """Strength per CPU-second of pure MCTS with each rollout policy: the
+    score against pure MCTS with random rollouts and `reference` playouts,
+    and the CPU time the tested player spent per move
+    """
+    print('{:<10}{:>10}{:>8}{:>14}{:>14}'.format(
+        'rollout', 'playouts', 'score', 'cpu ms/move', 'score/cpu-s'))
+    width, height, n_in_row = [int(x) for x in size.split('x')]
+    game = Game(Board(width=width, height=height, n_in_row=n_in_row))
+    for name, policy in (('random', random_rollout),
+                         ('heuristic', heuristic_rollout)):
+        for n_playout in playouts:
+            player = mcts_pure.MCTSPlayer(n_playout=n_playout,
+                                          rollout_policy=policy)
+            opponent = mcts_pure.MCTSPlayer(n_playout=reference)
+            cpu = [0.0, 0]
+            get_action = player.get_action
+
+            def timed_action(board):
+                start = time.process_time()
+                move = get_action(board)
+                cpu[0] += time.process_time() - start
+                cpu[1] += 1
+                return move
+            player.get_action = timed_action
+            score = 0.0
+            for i in range(n_games):
+                winner = game.start_play(player, opponent,
+                                         start_player=i % 2, is_shown=0)
+                score += 1.0 if winner == 1 else 0.5 if winner == -1 else 0
+            score /= n_games
+            per_move = cpu[0] / max(cpu[1], 1)
+            print('{:<10}{:>10}{:>8.2f}{:>14.1f}{:>14.2f}'.format(
+                name, n_playout, score, per_move * 1000, score / per_move))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('bench',
+                        choices=['tree', 'select', 'parallel', 'threads',
+                                 'rollout'])
+    parser.add_argument('--size', default='8x8x5',
+                        help='board size as WIDTHxHEIGHTxN_IN_ROW')
+    parser.add_argument('--playouts', nargs='+', type=int,
+                        default=[400, 5000])
+    parser.add_argument('--workers', nargs='+', type=int,
+                        default=[1, 2, 4, 8],
+                        help='numbers of processes for the parallel bench')
+    parser.add_argument('--threads', nargs='+', type=int,
+                        default=[1, 2, 4, 8],
+                        help='numbers of search threads for the threads bench')
+    parser.add_argument('--model',
+                        help='numpy model file of --size for the threads '
+                        'bench, instead of the stand-in policy')
+    parser.add_argument('--games', type=int, default=10,
+                        help='games per setting for the rollout bench')
+    parser.add_argument('--reference', type=int, default=1000,
+                        help='playouts of the random-rollout opponent in '
+                        'the rollout bench')
+    args = parser.parse_args()
+    if args.bench == 'tree':
+        bench_tree(args.size, args.playouts)
+    elif args.bench == 'select':
+        bench_select(args.size, args.playouts)
+    elif args.bench == 'parallel':
+        bench_parallel(args.size, args.playouts, args.workers)
+    elif args.bench == 'threads':
+        bench_threads(args.size, args.playouts, args.threads, args.model)
+    elif args.bench == 'rollout':
+        bench_rollout(args.size, args.playouts, args.games, args.reference)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded LRU cache of network evaluations, shared by the 8 symmetries of
+the board: positions that are rotations or mirror images of each other hit
+the same entry, with the policy mapped back onto the board asked for.
+"""
+
+from __future__ import print_function
+from collections import OrderedDict
+import numpy as np
+from game import symmetry_permutations
+
+
+class EvalCache(object):
+    """Drop-in wrapper of a policy_value_fn, and optionally of the matching
+    policy_value_batch_fn, that remembers the last max_size evaluations.
+
+    An entry is keyed by the canonical zobrist hash of the position, the
+    last move in the canonical frame (it is an input plane of the network)
+    and the player to move. The policy is stored in the canonical frame.
+    """
+
+    def __init__(self, policy_value_fn, max_size=100000,
+                 policy_value_batch_fn=None):
+        self._policy = policy_value_fn
+        self._policy_batch = policy_value_batch_fn
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        # inverse symmetry permutations, by board size
+        self._inverses = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, board):
+        """Return the cache key of board and its symmetry row"""
+        hash_value, symmetry = board.canonical_hash()
+        last_move = board.last_move
+        if last_move != -1:
+            perms = symmetry_permutations(board.width, board.height)
+            last_move = int(perms[symmetry, last_move])
+        return (hash_value, last_move, board.current_player), symmetry
+
+    def _lookup(self, board, key, symmetry):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        acts, probs, value = entry
+        size = (board.width, board.height)
+        if size not in self._inverses:
+            self._inverses[size] = np.argsort(
+                symmetry_permutations(board.width, board.height), axis=1)
+        acts = self._inverses[size][symmetry, acts]
+        return zip(acts.tolist(), probs), value
+
+    def _store(self, board, key, symmetry, result):
+        """Store result in the canonical frame, return it as the policy
+        function did
+        """
+        action_probs, value = result
+        action_probs = list(action_probs)
+        if action_probs:
+            acts, probs = zip(*action_probs)
+        else:
+            acts, probs = (), ()
+        perms = symmetry_permutations(board.width, board.height)
+        self._entries[key] = (perms[symmetry, list(acts)], np.array(probs),
+                              value)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return action_probs, value
+
+    def __call__(self, board):
+        """The wrapped policy_value_fn"""
+        key, symmetry = self._key(board)
+        result = self._lookup(board, key, symmetry)
+        if result is None:
+            result = self._store(board, key, symmetry, self._policy(board))
+        return result
+
+    def policy_value_batch_fn(self, boards):
+        """The wrapped policy_value_batch_fn: only the boards missing from
+        the cache are evaluated, in one batch
+        """
+        results = []
+        missing = []
+        for board in boards:
+            key, symmetry = self._key(board)
+            result = self._lookup(board, key, symmetry)
+            results.append(result)
+            if result is None:
+                missing.append((len(results) - 1, board, key, symmetry))
+        if missing:
+            if self._policy_batch is not None:
+                evaluated = self._policy_batch([m[1] for m in missing])
+            else:
+                evaluated = [self._policy(m[1]) for m in missing]
+            for (i, board, key, symmetry), result in zip(missing, evaluated):
+                results[i] = self._store(board, key, symmetry, result)
+        return results
+
+    def size(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        """Drop all entries, e.g. after the network is updated. The
+        counters are kept.
+        """
+        self._entries.clear()
+
+    def __str__(self):
+        return "EvalCache(size:{}, hit_rate:{:.3f}, evictions:{})".format(
+            self.size(), self.hit_rate(), self.evictions)
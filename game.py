@@ -4,8 +4,175 @@
 """
 
 from __future__ import print_function
+import bisect
+import copy
 import numpy as np
 
+# zobrist keys, symmetry and line tables, shared by all boards of the
+# same size
+_symmetry_cache = {}
+_zobrist_cache = {}
+_zobrist_int_cache = {}
+_line_table_cache = {}
+
+
+def symmetry_permutations(width, height):
+    """Map every move to its image under each symmetry of the board.
+
+    Returns an int array of shape (n_symmetries, width*height) where row s
+    gives, for each move, the move it becomes on the transformed board. The
+    symmetries are the rotations by 0, 90, 180 and 270 degrees, each
+    followed by the board itself and its mirror image, i.e. the 8
+    transformations used by TrainPipeline.get_equi_data (row 0 is the
+    identity). Non-square boards only keep the 4 that preserve the shape.
+    """
+    key = (width, height)
+    if key not in _symmetry_cache:
+        # grid[h][w] holds the move on location (h, w)
+        grid = np.arange(width * height).reshape(height, width)
+        perms = []
+        for i in range(4):
+            if width != height and i % 2:
+                continue
+            rotated = np.rot90(grid, i)
+            for equi in (rotated, np.fliplr(rotated)):
+                # equi[h][w] holds the move that lands on (h, w)
+                perm = np.empty(width * height, dtype=np.intp)
+                perm[equi.flatten()] = np.arange(width * height)
+                perms.append(perm)
+        _symmetry_cache[key] = np.array(perms)
+    return _symmetry_cache[key]
+
+
+def zobrist_keys(width, height):
+    """Return the uint64 zobrist keys of shape (2, width*height, S) used by
+    Board: keys[i, move, s] is xor-ed into the hash of symmetry s when
+    players[i] plays `move`, and already includes the side-to-move key.
+    The keys come from a fixed seed so hashes agree across processes.
+    """
+    key = (width, height)
+    if key not in _zobrist_cache:
+        size = width * height
+        rng = np.random.RandomState(size)
+        raw = np.frombuffer(rng.bytes(8 * (2 * size + 1)), dtype=np.uint64)
+        piece_keys, side_key = raw[:-1].reshape(2, size), raw[-1]
+        perms = symmetry_permutations(width, height)
+        keys = piece_keys[:, perms.T] ^ side_key
+        keys.flags.writeable = False
+        _zobrist_cache[key] = keys
+    return _zobrist_cache[key]
+
+
+def _identity_keys(width, height):
+    """Return the zobrist keys of the identity symmetry as lists of Python
+    ints, keys[i][move], which are cheaper to xor one move at a time
+    """
+    key = (width, height)
+    if key not in _zobrist_int_cache:
+        _zobrist_int_cache[key] = zobrist_keys(width, height)[:, :, 0].tolist()
+    return _zobrist_int_cache[key]
+
+
+class LineTable(object):
+    """Precomputed lines of a board with a given size and n_in_row.
+
+    windows: int array (n_windows, n_in_row), every run of n_in_row
+        locations along a row, column or diagonal, i.e. every way to win
+    cell_windows: for each move, an int array of the windows through it
+    rays: for each move, one (forward, backward) pair per line direction,
+        each a tuple of the next n_in_row-1 moves on the board going away
+        from it
+    open_windows: int array (n_open, n_in_row+1), the runs one longer than
+        a winning line, used to find open threats
+    window_masks: for each move, the bitmasks of the windows through it
+    """
+
+    def __init__(self, width, height, n_in_row):
+        self.width = width
+        self.height = height
+        self.n_in_row = n_in_row
+        n = n_in_row
+        directions = ((0, 1), (1, 0), (1, 1), (1, -1))
+        self.windows = self._runs(directions, n)
+        self.open_windows = self._runs(directions, n + 1)
+        size = width * height
+        cells = [[] for m in range(size)]
+        for i, window in enumerate(self.windows):
+            for m in window:
+                cells[m].append(i)
+        self.cell_windows = [np.array(c, dtype=np.intp) for c in cells]
+        masks = [sum(1 << int(m) for m in window) for window in self.windows]
+        self.window_masks = [[masks[i] for i in c] for c in cells]
+        self._neighbours = {}
+        self.rays = []
+        for m in range(size):
+            h, w = m // width, m % width
+            self.rays.append(tuple(
+                (self._ray(h, w, dh, dw, n - 1),
+                 self._ray(h, w, -dh, -dw, n - 1))
+                for dh, dw in directions))
+
+    def neighbours(self, distance):
+        """Return, for each move, an int array of the other moves at most
+        `distance` rows and columns away from it
+        """
+        if distance not in self._neighbours:
+            neighbours = []
+            for m in range(self.width * self.height):
+                h, w = m // self.width, m % self.width
+                neighbours.append(np.array(
+                    [ch * self.width + cw
+                     for ch in range(max(0, h - distance),
+                                     min(self.height, h + distance + 1))
+                     for cw in range(max(0, w - distance),
+                                     min(self.width, w + distance + 1))
+                     if (ch, cw) != (h, w)], dtype=np.intp))
+            self._neighbours[distance] = neighbours
+        return self._neighbours[distance]
+
+    def _ray(self, h, w, dh, dw, length):
+        ray = []
+        for i in range(1, length + 1):
+            ch, cw = h + i * dh, w + i * dw
+            if not (0 <= ch < self.height and 0 <= cw < self.width):
+                break
+            ray.append(ch * self.width + cw)
+        return tuple(ray)
+
+    def _runs(self, directions, length):
+        runs = []
+        for dh, dw in directions:
+            for h in range(self.height):
+                for w in range(self.width):
+                    ray = self._ray(h, w, dh, dw, length - 1)
+                    if len(ray) == length - 1:
+                        runs.append((h * self.width + w,) + ray)
+        return np.array(runs, dtype=np.intp).reshape(-1, length)
+
+
+def line_table(width, height, n_in_row):
+    """Return the LineTable of a board size, built once and shared"""
+    key = (width, height, n_in_row)
+    if key not in _line_table_cache:
+        _line_table_cache[key] = LineTable(width, height, n_in_row)
+    return _line_table_cache[key]
+
+
+def batch_policy_value(policy_value, boards):
+    """Evaluate boards in one call of a network's policy_value, which
+    takes a (n, 4, height, width) batch of current_state planes and
+    returns the batches of move probabilities and values. Return, for each
+    board, the (action, probability) tuples and score that the network's
+    policy_value_fn would.
+    """
+    state_batch = np.empty((len(boards), 4, boards[0].height,
+                            boards[0].width), dtype=np.float32)
+    for board, state in zip(boards, state_batch):
+        board.current_state(out=state)
+    act_probs, value = policy_value(state_batch)
+    return [(zip(board.availables, probs[board.availables]), v[0])
+            for board, probs, v in zip(boards, act_probs, value)]
+
 
 class Board(object):
     """board for the game"""
@@ -20,6 +187,9 @@ class Board(object):
         # need how many pieces in a row to win
         self.n_in_row = int(kwargs.get('n_in_row', 5))
         self.players = [1, 2]  # player1 and player2
+        # if set, the search only expands moves within this many rows and
+        # columns of a piece, see candidate_moves
+        self.candidate_distance = kwargs.get('candidate_distance')
 
     def init_board(self, start_player=0):
         if self.width < self.n_in_row or self.height < self.n_in_row:
@@ -30,6 +200,12 @@ class Board(object):
         self.availables = list(range(self.width * self.height))
         self.states = {}
         self.last_move = -1
+        # moves in the order they were played, and how many of them
+        # has_a_winner has already examined
+        self._moves = []
+        self._n_checked = 0
+        self._winner = -1
+        self._init_features(start_player)
 
     def move_to_location(self, move):
         """
@@ -53,68 +229,242 @@ class Board(object):
             return -1
         return move
 
-    def current_state(self):
+    def _init_features(self, start_player):
+        """Reset the feature planes returned by current_state, one set for
+        each player to move, and the zobrist hash of the board. Both are
+        kept up to date by do_move/undo_move; the hashes of the other
+        symmetries are only computed by canonical_hash.
+        """
+        self._planes = np.zeros((2, 4, self.height, self.width),
+                                dtype=np.float32)
+        self._planes[start_player, 3] = 1.0
+        self._zobrist_keys = zobrist_keys(self.width, self.height)
+        self._identity_keys = _identity_keys(self.width, self.height)
+        self._hash = 0
+        self._lines = line_table(self.width, self.height, self.n_in_row)
+        # the player on each location, 0 if empty
+        self._cells = np.zeros(self.width * self.height, dtype=np.int8)
+        if self.candidate_distance is not None:
+            self._neighbours = self._lines.neighbours(
+                int(self.candidate_distance))
+            # number of pieces near each location
+            self._near = np.zeros(self.width * self.height, dtype=np.int16)
+
+    def _plane_index(self, move):
+        # planes store the rows from the top of the board down
+        return self.height - 1 - move // self.width, move % self.width
+
+    def _place_features(self, move, cur):
+        """Mark a piece of self.players[cur] on `move` as the last move"""
+        h, w = self._plane_index(move)
+        planes = self._planes
+        planes[cur, 0, h, w] = 1.0
+        planes[1 - cur, 1, h, w] = 1.0
+        if self.last_move != -1:
+            last_h, last_w = self._plane_index(self.last_move)
+            planes[0, 2, last_h, last_w] = 0.0
+            planes[1, 2, last_h, last_w] = 0.0
+        planes[0, 2, h, w] = 1.0
+        planes[1, 2, h, w] = 1.0
+        self._hash ^= self._identity_keys[cur][move]
+        self._cells[move] = self.players[cur]
+        if self.candidate_distance is not None:
+            self._near[self._neighbours[move]] += 1
+
+    def _remove_features(self, move, cur):
+        """Inverse of _place_features, called once last_move is restored"""
+        h, w = self._plane_index(move)
+        planes = self._planes
+        planes[cur, 0, h, w] = 0.0
+        planes[1 - cur, 1, h, w] = 0.0
+        planes[0, 2, h, w] = 0.0
+        planes[1, 2, h, w] = 0.0
+        if self.last_move != -1:
+            last_h, last_w = self._plane_index(self.last_move)
+            planes[0, 2, last_h, last_w] = 1.0
+            planes[1, 2, last_h, last_w] = 1.0
+        self._hash ^= self._identity_keys[cur][move]
+        self._cells[move] = 0
+        if self.candidate_distance is not None:
+            self._near[self._neighbours[move]] -= 1
+
+    def candidate_moves(self):
+        """Return the moves worth expanding in the search: all of
+        `availables` unless candidate_distance is set, in which case only
+        the empty locations within that distance of a piece, or the centre
+        of the board on the first move.
+        """
+        if self.candidate_distance is None:
+            return self.availables
+        if self.last_move == -1:
+            centre = (self.height // 2) * self.width + self.width // 2
+            if self._cells[centre] == 0:
+                return [centre]
+        moves = np.flatnonzero((self._near > 0) & (self._cells == 0))
+        if not len(moves):
+            return self.availables
+        return moves.tolist()
+
+    def candidate_priors(self, action_priors):
+        """Keep the (action, prior) pairs whose action is a candidate move,
+        for the MCTS engines to expand
+        """
+        if self.candidate_distance is None:
+            return action_priors
+        candidates = set(self.candidate_moves())
+        return [(action, prior) for action, prior in action_priors
+                if action in candidates]
+
+    def zobrist_hash(self):
+        """Return the 64-bit zobrist hash of the pieces and side to move"""
+        return self._hash
+
+    def canonical_hash(self):
+        """Return (hash, symmetry): the smallest zobrist hash over the
+        board symmetries, and the row of symmetry_permutations that maps
+        this board onto the position with that hash. The hashes of all the
+        symmetries are xor-ed from the pieces on the board at each call.
+        """
+        cells = self._cells
+        stones = np.flatnonzero(cells)
+        owners = (cells[stones] == self.players[1]).astype(np.intp)
+        hashes = np.bitwise_xor.reduce(self._zobrist_keys[owners, stones],
+                                       axis=0)
+        symmetry = int(hashes.argmin())
+        return int(hashes[symmetry]), symmetry
+
+    def current_state(self, out=None):
         """return the board state from the perspective of the current player.
-        state shape: 4*width*height
-        """
-
-        square_state = np.zeros((4, self.width, self.height))
-        if self.states:
-            moves, players = np.array(list(zip(*self.states.items())))
-            move_curr = moves[players == self.current_player]
-            move_oppo = moves[players != self.current_player]
-            square_state[0][move_curr // self.width,
-                            move_curr % self.height] = 1.0
-            square_state[1][move_oppo // self.width,
-                            move_oppo % self.height] = 1.0
-            # indicate the last move location
-            square_state[2][self.last_move // self.width,
-                            self.last_move % self.height] = 1.0
-        if len(self.states) % 2 == 0:
-            square_state[3][:, :] = 1.0  # indicate the colour to play
-        return square_state[:, ::-1, :]
+        state shape: 4*height*width, float32, with the rows ordered from the
+        top of the board (row height-1) down, and the planes:
+            0: pieces of the current player
+            1: pieces of the opponent
+            2: the last move
+            3: all ones if the current player started the game
+        The planes are maintained incrementally by do_move/undo_move. The
+        result is a read-only view that follows later moves; pass `out` to
+        get a copy written into a caller-provided buffer instead.
+        """
+        cur = 0 if self.current_player == self.players[0] else 1
+        if out is not None:
+            out[...] = self._planes[cur]
+            return out
+        state = self._planes[cur].view()
+        state.flags.writeable = False
+        return state
 
     def do_move(self, move):
         self.states[move] = self.current_player
         self.availables.remove(move)
+        self._place_features(
+            move, 0 if self.current_player == self.players[0] else 1)
         self.current_player = (
             self.players[0] if self.current_player == self.players[1]
             else self.players[1]
         )
         self.last_move = move
+        self._moves.append(move)
 
-    def has_a_winner(self):
-        width = self.width
-        height = self.height
-        states = self.states
-        n = self.n_in_row
+    def undo_move(self):
+        """Take back the last move, restoring the board as it was before
+        the matching do_move.
+        """
+        move = self._moves.pop()
+        self.current_player = self.states.pop(move)
+        bisect.insort(self.availables, move)
+        self.last_move = self._moves[-1] if self._moves else -1
+        self._remove_features(
+            move, 0 if self.current_player == self.players[0] else 1)
+        if self._n_checked > len(self._moves):
+            # the move was already examined, and may be the winning one
+            self._n_checked = len(self._moves)
+            self._winner = -1
 
-        moved = list(set(range(width * height)) - set(self.availables))
-        if len(moved) < self.n_in_row *2-1:
-            return False, -1
+    def clone(self):
+        """Return an independent copy of the board, cheaper than
+        copy.deepcopy since only the containers need to be copied.
+        """
+        board = copy.copy(self)
+        board.states = self.states.copy()
+        board.availables = self.availables[:]
+        board._moves = self._moves[:]
+        board._planes = self._planes.copy()
+        board._cells = self._cells.copy()
+        if self.candidate_distance is not None:
+            board._near = self._near.copy()
+        return board
 
-        for m in moved:
-            h = m // width
-            w = m % width
-            player = states[m]
+    def has_a_winner(self):
+        """Check the lines through every move played since the last call.
 
-            if (w in range(width - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n))) == 1):
-                return True, player
+        Only a newly placed piece can complete a line, so each move is
+        examined once; the first winner found is kept in self._winner.
+        """
+        while self._winner == -1 and self._n_checked < len(self._moves):
+            move = self._moves[self._n_checked]
+            self._n_checked += 1
+            if self._is_winning_move(move):
+                self._winner = self.states[move]
+        if self._winner != -1:
+            return True, self._winner
+        return False, -1
 
-            if (h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * width, width))) == 1):
-                return True, player
+    def _is_winning_move(self, move):
+        """Check whether the piece on `move` is part of n_in_row pieces
+        in a row, looking only at the lines through it.
+        """
+        states = self.states
+        n = self.n_in_row
+        player = states[move]
+        for ray_pair in self._lines.rays[move]:
+            count = 1
+            for ray in ray_pair:
+                for m in ray:
+                    if states.get(m, -1) != player:
+                        break
+                    count += 1
+            if count >= n:
+                return True
+        return False
 
-            if (w in range(width - n + 1) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width + 1), width + 1))) == 1):
-                return True, player
+    def scan_threats(self):
+        """Find the tactical moves of the current player.
 
-            if (w in range(n - 1, width) and h in range(height - n + 1) and
-                    len(set(states.get(i, -1) for i in range(m, m + n * (width - 1), width - 1))) == 1):
-                return True, player
+        Returns a dict of sorted lists of moves:
+            win: moves that complete n_in_row pieces in a row
+            block: moves the opponent would win with, which must be blocked
+            open_four: moves leaving n_in_row-1 pieces in a row with both
+                ends empty, i.e. two ways to win on the next move
+            open_three: moves leaving n_in_row-2 pieces, possibly with one
+                gap, inside n_in_row-1 locations with both ends empty
+        """
+        n = self.n_in_row
+        player = self.current_player
+        opponent = (self.players[0] if player == self.players[1]
+                    else self.players[1])
+        cells = self._cells
+        windows = self._lines.windows
+        lines = cells[windows]
+        empty = lines == 0
+        n_empty = empty.sum(axis=1)
+        threats = {}
+        for key, side in (('win', player), ('block', opponent)):
+            # n_in_row-1 pieces of one side and an empty location
+            hit = (n_empty == 1) & ((lines == side).sum(axis=1) == n - 1)
+            threats[key] = sorted(set(windows[hit][empty[hit]].tolist()))
 
-        return False, -1
+        windows = self._lines.open_windows
+        lines = cells[windows]
+        ends_empty = (lines[:, 0] == 0) & (lines[:, -1] == 0)
+        inner = lines[:, 1:-1]
+        empty = inner == 0
+        n_own = (inner == player).sum(axis=1)
+        n_empty = empty.sum(axis=1)
+        for key, n_gaps in (('open_four', 1), ('open_three', 2)):
+            hit = ends_empty & (n_empty == n_gaps) & (n_own == n - 1 - n_gaps)
+            moves = windows[hit][:, 1:-1][empty[hit]]
+            threats[key] = sorted(set(moves.tolist()))
+        return threats
 
     def game_end(self):
         """Check whether the game is ended or not"""
@@ -129,6 +479,228 @@ class Board(object):
         return self.current_player
 
 
+class BitBoard(Board):
+    """board for the game, backed by one integer bitboard per player.
+
+    Bit `move` of self.bits[i] is set when self.players[i] has a piece on
+    that location. Legal moves are kept in `availables` together with the
+    position of every move in that list, so that do_move can drop a move by
+    swapping it with the last one instead of searching the list. The order
+    of `availables` is therefore not sorted, but it holds the same moves as
+    Board.availables. `states` is rebuilt from the bitboards on access,
+    and win detection tests the line masks through each new move.
+    """
+
+    def __init__(self, **kwargs):
+        self.width = int(kwargs.get('width', 8))
+        self.height = int(kwargs.get('height', 8))
+        # need how many pieces in a row to win
+        self.n_in_row = int(kwargs.get('n_in_row', 5))
+        self.players = [1, 2]  # player1 and player2
+        self.candidate_distance = kwargs.get('candidate_distance')
+        self.bits = [0, 0]
+
+    def init_board(self, start_player=0):
+        if self.width < self.n_in_row or self.height < self.n_in_row:
+            raise Exception('board width and height can not be '
+                            'less than {}'.format(self.n_in_row))
+        self.current_player = self.players[start_player]  # start player
+        size = self.width * self.height
+        self.availables = list(range(size))
+        # position of each move inside self.availables
+        self._avail_index = list(range(size))
+        self.bits = [0, 0]
+        self.last_move = -1
+        self._moves = []
+        self._n_checked = 0
+        self._winner = -1
+        self._init_features(start_player)
+
+    @property
+    def states(self):
+        states = {}
+        for player, bits in zip(self.players, self.bits):
+            while bits:
+                low = bits & -bits
+                states[low.bit_length() - 1] = player
+                bits ^= low
+        return states
+
+    def do_move(self, move):
+        bit = 1 << move
+        if (self.bits[0] | self.bits[1]) & bit:
+            raise ValueError('move {} is not available'.format(move))
+        cur = 0 if self.current_player == self.players[0] else 1
+        self.bits[cur] |= bit
+        # swap the move with the last available one and drop it
+        index = self._avail_index[move]
+        last = self.availables.pop()
+        if last != move:
+            self.availables[index] = last
+            self._avail_index[last] = index
+        self._place_features(move, cur)
+        self.current_player = self.players[1 - cur]
+        self.last_move = move
+        self._moves.append(move)
+
+    def undo_move(self):
+        """Take back the last move, restoring `availables` to the exact
+        order it had before the matching do_move.
+        """
+        move = self._moves.pop()
+        cur = 1 if self.current_player == self.players[0] else 0
+        self.bits[cur] ^= 1 << move
+        # do_move moved the last available move into the slot of `move`
+        index = self._avail_index[move]
+        if index < len(self.availables):
+            last = self.availables[index]
+            self._avail_index[last] = len(self.availables)
+            self.availables.append(last)
+            self.availables[index] = move
+        else:
+            self.availables.append(move)
+        self.current_player = self.players[cur]
+        self.last_move = self._moves[-1] if self._moves else -1
+        self._remove_features(move, cur)
+        if self._n_checked > len(self._moves):
+            self._n_checked = len(self._moves)
+            self._winner = -1
+
+    def clone(self):
+        board = copy.copy(self)
+        board.bits = self.bits[:]
+        board.availables = self.availables[:]
+        board._avail_index = self._avail_index[:]
+        board._moves = self._moves[:]
+        board._planes = self._planes.copy()
+        board._cells = self._cells.copy()
+        if self.candidate_distance is not None:
+            board._near = self._near.copy()
+        return board
+
+    def _is_winning_move(self, move):
+        bits = self.bits[0] if (self.bits[0] >> move) & 1 else self.bits[1]
+        for mask in self._lines.window_masks[move]:
+            if bits & mask == mask:
+                return True
+        return False
+
+
+class BoardBatch(object):
+    """A batch of boards of the same size, stepped together.
+
+    The games are stored as stacked numpy arrays so that a whole vector of
+    moves is applied, checked for wins and turned into network input in a
+    few array operations instead of one Python loop per game:
+        cells: int8 array (n_games, width*height), 0 for an empty location
+            or the player whose piece is there
+        current_player, last_move, n_moves, winner: one entry per game,
+            with winner -1 while no one has won
+    """
+
+    def __init__(self, n_games, **kwargs):
+        self.n_games = int(n_games)
+        self.width = int(kwargs.get('width', 8))
+        self.height = int(kwargs.get('height', 8))
+        # need how many pieces in a row to win
+        self.n_in_row = int(kwargs.get('n_in_row', 5))
+        self.players = [1, 2]  # player1 and player2
+
+    def init_board(self, start_player=0):
+        """start_player: 0 or 1, or an array with one value per game"""
+        if self.width < self.n_in_row or self.height < self.n_in_row:
+            raise Exception('board width and height can not be '
+                            'less than {}'.format(self.n_in_row))
+        n = self.n_games
+        start_player = np.broadcast_to(start_player, (n,))
+        players = np.array(self.players, dtype=np.int8)
+        self.start_player = players[start_player]
+        self.current_player = self.start_player.copy()
+        self.cells = np.zeros((n, self.width * self.height), dtype=np.int8)
+        self.last_move = np.full(n, -1, dtype=np.intp)
+        self.n_moves = np.zeros(n, dtype=np.intp)
+        self.winner = np.full(n, -1, dtype=np.int8)
+
+    def legal_mask(self):
+        """Return a bool array (n_games, width*height) of empty locations,
+        all False for games that have ended.
+        """
+        end, _ = self.game_end()
+        return (self.cells == 0) & ~end[:, None]
+
+    def do_moves(self, moves):
+        """Play moves[i] in game i for every game that has not ended yet.
+        Entries of ended games, or negative entries, are ignored.
+        """
+        moves = np.asarray(moves, dtype=np.intp)
+        end, _ = self.game_end()
+        games = np.flatnonzero((moves >= 0) & ~end)
+        moves = moves[games]
+        if np.any(self.cells[games, moves]):
+            raise ValueError('moves {} are not available'.format(
+                moves[self.cells[games, moves] != 0]))
+        players = self.current_player[games]
+        self.cells[games, moves] = players
+        self.last_move[games] = moves
+        self.n_moves[games] += 1
+        self.current_player[games] = np.where(
+            players == self.players[0], self.players[1], self.players[0])
+        # only the player who just moved can have completed a line
+        for player in self.players:
+            mover = games[players == player]
+            won = self._has_line(self.cells[mover] == player)
+            self.winner[mover[won]] = player
+
+    def _has_line(self, stones):
+        """stones: bool array (k, width*height) of one player's pieces.
+        Return a bool array (k,) telling which games contain n_in_row of
+        them in a row, found by and-ing shifted copies of the boards along
+        each of the four line directions.
+        """
+        n = self.n_in_row
+        height, width = self.height, self.width
+        stones = stones.reshape(-1, height, width)
+        found = np.zeros(len(stones), dtype=bool)
+        for dh, dw in ((0, 1), (1, 0), (1, 1), (1, -1)):
+            h_len = height - (n - 1) * dh
+            w_len = width - (n - 1) * abs(dw)
+            # first column of the windows, so that every window fits
+            w0 = (n - 1) if dw < 0 else 0
+            run = stones[:, :h_len, w0:w0 + w_len].copy()
+            for i in range(1, n):
+                run &= stones[:, i * dh:i * dh + h_len,
+                              w0 + i * dw:w0 + i * dw + w_len]
+            found |= run.any(axis=(1, 2))
+        return found
+
+    def game_end(self):
+        """Return two arrays (n_games,): whether each game has ended, and
+        its winner (-1 for a tie or a game still running).
+        """
+        full = self.n_moves == self.width * self.height
+        return (self.winner != -1) | full, self.winner.copy()
+
+    def current_state(self, out=None):
+        """Return the stacked input of all games, as a float32 array of
+        shape (n_games, 4, height, width) laid out like
+        Board.current_state for each game. Pass `out` to write the result
+        into a caller-provided buffer.
+        """
+        n, size = self.cells.shape
+        if out is None:
+            out = np.empty((n, 4, self.height, self.width), dtype=np.float32)
+        # build the planes with the rows from the bottom up, then reverse
+        planes = np.zeros((n, 4, size), dtype=np.float32)
+        own = self.cells == self.current_player[:, None]
+        planes[:, 0] = own
+        planes[:, 1] = (self.cells != 0) & ~own
+        moved = np.flatnonzero(self.last_move >= 0)
+        planes[moved, 2, self.last_move[moved]] = 1.0
+        planes[:, 3] = (self.n_moves % 2 == 0)[:, None]
+        out[...] = planes.reshape(n, 4, self.height, self.width)[:, :, ::-1]
+        return out
+
+
 class Game(object):
     """game server"""
 
@@ -187,21 +759,31 @@ class Game(object):
                         print("Game end. Tie")
                 return winner
 
-    def start_self_play(self, player, is_shown=0, temp=1e-3):
+    def start_self_play(self, player, is_shown=0, temp=1e-3, record=None):
         """ start a self-play game using a MCTS player, reuse the search tree,
-        and store the self-play data: (state, mcts_probs, z) for training
+        and store the self-play data: (state, mcts_probs, z, full_search) for
+        training. full_search is False for the moves the player searched
+        with a reduced budget (playout cap randomization), whose mcts_probs
+        are not a policy target and should only train the value.
+        record: an optional game_record.GameRecord filled with the moves,
+            visit distributions and result of the game
         """
         self.board.init_board()
         p1, p2 = self.board.players
         states, mcts_probs, current_players = [], [], []
+        full_searches = []
         while True:
             move, move_probs = player.get_action(self.board,
                                                  temp=temp,
                                                  return_prob=1)
+            full_search = getattr(player, 'full_search', True)
             # store the data
-            states.append(self.board.current_state())
+            states.append(self.board.current_state().copy())
             mcts_probs.append(move_probs)
             current_players.append(self.board.current_player)
+            full_searches.append(full_search)
+            if record is not None:
+                record.add_move(move, move_probs if full_search else None)
             # perform a move
             self.board.do_move(move)
             if is_shown:
@@ -213,6 +795,8 @@ class Game(object):
                 if winner != -1:
                     winners_z[np.array(current_players) == winner] = 1.0
                     winners_z[np.array(current_players) != winner] = -1.0
+                if record is not None:
+                    record.winner = winner
                 # reset MCTS root node
                 player.reset_player()
                 if is_shown:
@@ -220,4 +804,5 @@ class Game(object):
                         print("Game end. Winner is player:", winner)
                     else:
                         print("Game end. Tie")
-                return winner, zip(states, mcts_probs, winners_z)
+                return winner, zip(states, mcts_probs, winners_z,
+                                   full_searches)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for self-play games, and a replayer that turns the
+stored games back into training data on demand
+
+A record only keeps the move sequence, the sparse MCTS visit distribution
+of every move, the result and the board config, instead of the full
+4*width*height input planes and dense probability vector of every move.
+"""
+
+from __future__ import print_function
+import struct
+import numpy as np
+from game import Board
+
+MAGIC = b'GMKR'
+VERSION = 1
+# magic, version, width, height, n_in_row, start_player, winner,
+# n_moves, length of the model id
+_HEADER = struct.Struct('<4sBBBBBbHH')
+# probabilities are stored as fractions of this value
+_PROB_SCALE = 65535
+
+
+class GameRecord(object):
+    """The moves and search results of one game"""
+
+    def __init__(self, width, height, n_in_row, start_player=0, model_id=''):
+        self.width = width
+        self.height = height
+        self.n_in_row = n_in_row
+        self.start_player = start_player
+        self.model_id = model_id
+        self.moves = []
+        # sparse visit distribution of each move: (acts, probs) arrays
+        self.visits = []
+        self.winner = -1
+
+    def add_move(self, move, move_probs=None):
+        """move_probs: the dense pi vector returned by MCTSPlayer, or None
+        for a move that has no policy target
+        """
+        if move_probs is None:
+            acts = np.zeros(0, dtype=np.uint16)
+            probs = np.zeros(0, dtype=np.uint16)
+        else:
+            move_probs = np.asarray(move_probs)
+            probs = np.round(move_probs * _PROB_SCALE)
+            acts = np.flatnonzero(probs).astype(np.uint16)
+            probs = probs[acts].astype(np.uint16)
+        self.moves.append(move)
+        self.visits.append((acts, probs))
+
+    def to_bytes(self):
+        model_id = self.model_id.encode('utf-8')
+        parts = [_HEADER.pack(MAGIC, VERSION, self.width, self.height,
+                              self.n_in_row, self.start_player, self.winner,
+                              len(self.moves), len(model_id)),
+                 model_id,
+                 np.array(self.moves, dtype='<u2').tobytes()]
+        for acts, probs in self.visits:
+            parts.append(struct.pack('<H', len(acts)))
+            parts.append(acts.astype('<u2').tobytes())
+            parts.append(probs.astype('<u2').tobytes())
+        return b''.join(parts)
+
+    def move_probs(self, i):
+        """Return the dense probability vector of move i, or None if it was
+        recorded without one
+        """
+        acts, probs = self.visits[i]
+        if not len(acts):
+            return None
+        move_probs = np.zeros(self.width * self.height, dtype=np.float32)
+        move_probs[acts] = probs
+        return move_probs / move_probs.sum()
+
+
+def record_from_bytes(data, offset=0):
+    """Parse one record starting at `offset` in `data`.
+    Return the record and the offset right after it.
+    """
+    (magic, version, width, height, n_in_row, start_player, winner,
+     n_moves, id_len) = _HEADER.unpack_from(data, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a game record at offset {}'.format(offset))
+    offset += _HEADER.size
+    model_id = bytes(data[offset:offset + id_len]).decode('utf-8')
+    offset += id_len
+    record = GameRecord(width, height, n_in_row, start_player, model_id)
+    record.winner = winner
+    record.moves = np.frombuffer(data, dtype='<u2', count=n_moves,
+                                 offset=offset).tolist()
+    offset += 2 * n_moves
+    for i in range(n_moves):
+        k, = struct.unpack_from('<H', data, offset)
+        offset += 2
+        acts = np.frombuffer(data, dtype='<u2', count=k, offset=offset)
+        offset += 2 * k
+        probs = np.frombuffer(data, dtype='<u2', count=k, offset=offset)
+        offset += 2 * k
+        record.visits.append((acts, probs))
+    return record, offset
+
+
+def write_records(path, records):
+    """Append the records to a file"""
+    with open(path, 'ab') as f:
+        for record in records:
+            f.write(record.to_bytes())
+
+
+def read_records(path):
+    """Return the list of records stored in a file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset < len(data):
+        record, offset = record_from_bytes(data, offset)
+        records.append(record)
+    return records
+
+
+def replay(records):
+    """Replay the games into training data.
+
+    Returns (state_batch, mcts_probs_batch, winner_batch, full_search_batch)
+    as arrays of shapes (n, 4, height, width), (n, width*height), (n,) and
+    (n,), the same data Game.start_self_play produces, for every move.
+    full_search_batch is False for the moves recorded without a
+    probability vector, such as the fast searches of playout cap
+    randomization: their mcts_probs are all zero and only their state and
+    winner are training data. All records must share the same board size.
+    """
+    n_samples = sum(len(r.moves) for r in records)
+    if not n_samples:
+        raise ValueError('no moves in the records')
+    first = records[0]
+    state_batch = np.empty((n_samples, 4, first.height, first.width),
+                           dtype=np.float32)
+    mcts_probs_batch = np.zeros((n_samples, first.width * first.height),
+                                dtype=np.float32)
+    winner_batch = np.zeros(n_samples, dtype=np.float32)
+    full_search_batch = np.zeros(n_samples, dtype=bool)
+    i = 0
+    for record in records:
+        if (record.width, record.height) != (first.width, first.height):
+            raise ValueError('records of different board sizes')
+        board = Board(width=record.width, height=record.height,
+                      n_in_row=record.n_in_row)
+        board.init_board(record.start_player)
+        for t, move in enumerate(record.moves):
+            acts, probs = record.visits[t]
+            board.current_state(out=state_batch[i])
+            if len(acts):
+                mcts_probs_batch[i, acts] = probs
+                mcts_probs_batch[i] /= mcts_probs_batch[i].sum()
+                full_search_batch[i] = True
+            # winner from the perspective of the current player
+            if record.winner != -1:
+                winner_batch[i] = (1.0 if board.current_player ==
+                                   record.winner else -1.0)
+            i += 1
+            board.do_move(move)
+    return state_batch, mcts_probs_batch, winner_batch, full_search_batch
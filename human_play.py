@@ -14,6 +14,7 @@ import numpy as np
 from game import Board, Game
 from mcts_pure import MCTSPlayer as MCTS_Pure
 from mcts_alphaZero import MCTSPlayer
+from eval_cache import EvalCache
 from policy_value_net_numpy import PolicyValueNetNumpy
 # from policy_value_net import PolicyValueNet  # Theano and Lasagne
 # from policy_value_net_pytorch import PolicyValueNet  # Pytorch
@@ -351,6 +352,8 @@ class Human(object):
                             print("Position already occupied!")
                     else:
                         print("Click within the board!")
+            # leave the CPU to a pondering AI between polls
+            pg.time.wait(10)
                         
         return self.move
 
@@ -358,7 +361,17 @@ class Human(object):
         return "Human {}".format(self.player)
 
 
-def run():
+def run(move_time=None, game_time=None, early_stop=True,
+        max_tree_bytes=256 * 2 ** 20):
+    """
+    move_time, game_time: thinking time of the AI in milliseconds, per move
+        or per game, instead of a fixed number of playouts
+    early_stop: let the AI move as soon as its choice is decided
+    max_tree_bytes: memory budget of the AI's search tree, which also ends
+        its pondering during the human's turn
+    """
+    # playouts per move, or the most playouts of a timed move
+    n_playout = 400 if move_time is None and game_time is None else None
     while True:  # 主游戏循环
         # 使用pygame界面获取游戏设置
         menu = GameMenu()
@@ -383,9 +396,15 @@ def run():
                 policy_param = pickle.load(open(model_file, 'rb'),
                                            encoding='bytes')  # To support python3
             best_policy = PolicyValueNetNumpy(width, height, policy_param)
-            mcts_player = MCTSPlayer(best_policy.policy_value_fn,
+            # remember the evaluations, up to symmetry, across moves and games
+            policy_value_fn = EvalCache(best_policy.policy_value_fn)
+            mcts_player = MCTSPlayer(policy_value_fn,
                                      c_puct=5,
-                                     n_playout=400)  # set larger n_playout for better performance
+                                     n_playout=n_playout,  # set larger n_playout for better performance
+                                     move_time=move_time,
+                                     game_time=game_time,
+                                     early_stop=early_stop,
+                                     max_bytes=max_tree_bytes)
 
             restart_game = True
             while restart_game:
@@ -414,13 +433,16 @@ def run():
                     else:
                         print("游戏开始! AI是黑子先手，你是白子。")
                     
-                    # 人类 vs AI 游戏循环
-                    restart_game = run_human_vs_ai(board, game_ui, human, mcts_player)
+                    # 人类 vs AI 游戏循环, the AI keeps searching while the human thinks
+                    restart_game = run_human_vs_ai(board, game_ui, human, mcts_player,
+                                                   ponder=True)
                     
                 else:
                     # AI vs AI 模式
-                    ai_player1 = MCTSPlayer(best_policy.policy_value_fn, c_puct=5, n_playout=400)
-                    ai_player2 = MCTSPlayer(best_policy.policy_value_fn, c_puct=5, n_playout=400)
+                    ai_player1 = MCTSPlayer(policy_value_fn, c_puct=5, n_playout=n_playout,
+                                            move_time=move_time, game_time=game_time, early_stop=early_stop)
+                    ai_player2 = MCTSPlayer(policy_value_fn, c_puct=5, n_playout=n_playout,
+                                            move_time=move_time, game_time=game_time, early_stop=early_stop)
                     ai_player1.set_player_ind(1)
                     ai_player2.set_player_ind(2)
                     
@@ -448,14 +470,19 @@ def run():
             break
 
 
-def run_human_vs_ai(board, game_ui, human, mcts_player):
-    """人类 vs AI 游戏循环"""
+def run_human_vs_ai(board, game_ui, human, mcts_player, ponder=False):
+    """人类 vs AI 游戏循环
+    ponder: let the AI search in the background during the human's turn
+    """
     while True:
         current_player = board.current_player
         
         if current_player == human.player:  # 人类回合
             print("轮到你了...")
+            if ponder:
+                mcts_player.start_pondering(board)
             move = human.get_action(board)
+            mcts_player.stop_pondering()
             board.do_move(move)
             game_ui.draw()
             pg.display.update()
@@ -471,6 +498,7 @@ def run_human_vs_ai(board, game_ui, human, mcts_player):
             move = mcts_player.get_action(board)
             board.do_move(move)
             print(f"AI 落子位置: {board.move_to_location(move)}")
+            print("({n_playout} playouts, {time:.2f}s)".format(**mcts_player.last_search))
             game_ui.draw()
             pg.display.update()
             
@@ -6,8 +6,12 @@ network to guide the tree search and evaluate the leaf nodes
 @author: Junxiao Song
 """
 
+import queue
+import threading
+import time
 import numpy as np
-import copy
+from mcts_parallel import RootParallelMCTS
+from search_stats import SearchStats, no_tick
 
 
 def softmax(x):
@@ -20,33 +24,111 @@ class TreeNode(object):
     """A node in the MCTS tree.
 
     Each node keeps track of its own value Q, prior probability P, and
-    its visit-count-adjusted prior score u.
+    its visit-count-adjusted prior score u. A node also keeps the Q, P and
+    visit counts of its children in contiguous arrays, in the order the
+    children were expanded, so that select scores them all at once.
+
+    A node can be proven, as in MCTS-Solver: its game-theoretic value is
+    known to be a win (1), draw (0) or loss (-1) for the player who moved
+    into it. The parent then always selects a proven win and avoids proven
+    losses.
     """
 
-    def __init__(self, parent, prior_p):
+    __slots__ = ('_parent', '_index', '_children', '_n_visits', '_n_virtual',
+                 '_Q', '_u', '_P', '_child_actions', '_child_nodes',
+                 '_child_Q', '_child_P', '_child_N', '_proven', '_complete',
+                 '_child_bonus')
+
+    def __init__(self, parent, prior_p, index=0):
+        """index: position of this node among the children of parent"""
         self._parent = parent
+        self._index = index
         self._children = {}  # a map from action to TreeNode
         self._n_visits = 0
+        # visits in flight in a batched search, counted as losses
+        self._n_virtual = 0
         self._Q = 0
         self._u = 0
         self._P = prior_p
+        # actions, nodes and stats of the children, in expansion order
+        self._child_actions = []
+        self._child_nodes = []
+        self._child_Q = None
+        self._child_P = None
+        self._child_N = None
+        # proven value, or None
+        self._proven = None
+        # whether the children cover every legal move
+        self._complete = False
+        # +inf / -inf for the children that are proven wins / losses
+        self._child_bonus = None
 
     def expand(self, action_priors):
         """Expand tree by creating new children.
         action_priors: a list of tuples of actions and their prior probability
             according to the policy function.
+        Return the number of children created.
         """
+        n_children = len(self._child_nodes)
         for action, prob in action_priors:
             if action not in self._children:
-                self._children[action] = TreeNode(self, prob)
+                node = TreeNode(self, prob, len(self._child_nodes))
+                self._children[action] = node
+                self._child_actions.append(action)
+                self._child_nodes.append(node)
+        if len(self._child_nodes) != n_children:
+            nodes = self._child_nodes
+            self._child_Q = np.array([node._Q for node in nodes], dtype=float)
+            self._child_P = np.array([node._P for node in nodes], dtype=float)
+            self._child_N = np.array([node._n_visits for node in nodes],
+                                     dtype=float)
+            if self._child_bonus is not None:
+                # 0 * inf is nan, so unproven and drawn children get 0
+                self._child_bonus = np.array(
+                    [node._proven * np.inf if node._proven else 0.0
+                     for node in nodes])
+        return len(self._child_nodes) - n_children
+
+    def set_proven(self, value):
+        """Mark this node as proven, with value from the perspective of the
+        player who moved into it
+        """
+        self._proven = value
+        parent = self._parent
+        if value and parent is not None:
+            if parent._child_bonus is None:
+                parent._child_bonus = np.zeros(len(parent._child_nodes))
+            parent._child_bonus[self._index] = value * np.inf
+
+    def collapse(self):
+        """Drop all children, turning this node back into a leaf that keeps
+        its own statistics. Return the list of dropped children.
+        """
+        nodes = self._child_nodes
+        self._children = {}
+        self._child_actions = []
+        self._child_nodes = []
+        self._child_Q = None
+        self._child_P = None
+        self._child_N = None
+        self._complete = False
+        self._child_bonus = None
+        return nodes
 
     def select(self, c_puct):
         """Select action among children that gives maximum action value Q
-        plus bonus u(P).
+        plus bonus u(P), scoring all children in one array operation. Ties
+        go to the child expanded first, as with max() over the children.
         Return: A tuple of (action, next_node)
         """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
+        values = self._child_Q + (c_puct * self._child_P *
+                                  np.sqrt(self._n_visits +
+                                          self._n_virtual) /
+                                  (1 + self._child_N))
+        if self._child_bonus is not None:
+            values += self._child_bonus
+        i = int(np.argmax(values))
+        return self._child_actions[i], self._child_nodes[i]
 
     def update(self, leaf_value):
         """Update node values from leaf evaluation.
@@ -57,14 +139,40 @@ class TreeNode(object):
         self._n_visits += 1
         # Update Q, a running average of values for all visits.
         self._Q += 1.0*(leaf_value - self._Q) / self._n_visits
+        if self._parent is not None:
+            if self._n_virtual:
+                self._update_parent_stats()
+            else:
+                self._parent._child_N[self._index] = self._n_visits
+                self._parent._child_Q[self._index] = self._Q
+
+    def add_virtual_loss(self, n):
+        """Add n visits in flight (or remove them, with n < 0). Until they
+        are backed up, the parent sees each of them as a lost visit, which
+        steers the other paths of a batch away from this node.
+        """
+        self._n_virtual += n
+        if self._parent is not None:
+            self._update_parent_stats()
+
+    def _update_parent_stats(self):
+        """Write N and Q, including the visits in flight, to the parent"""
+        n_visits = self._n_visits + self._n_virtual
+        Q = self._Q
+        if self._n_virtual:
+            Q = (self._Q * self._n_visits - self._n_virtual) / n_visits
+        self._parent._child_N[self._index] = n_visits
+        self._parent._child_Q[self._index] = Q
 
     def update_recursive(self, leaf_value):
-        """Like a call to update(), but applied recursively for all ancestors.
+        """Like a call to update(), but applied to all ancestors as well,
+        flipping the sign of the value at every level.
         """
-        # If it is not root, this node's parent should be updated first.
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
+        node = self
+        while node is not None:
+            node.update(leaf_value)
+            leaf_value = -leaf_value
+            node = node._parent
 
     def get_value(self, c_puct):
         """Calculate and return the value for this node.
@@ -85,10 +193,103 @@ class TreeNode(object):
         return self._parent is None
 
 
+class SearchLimit(object):
+    """Decides when a search is over: after n_playout playouts, once
+    move_time milliseconds have passed, or, with early_stop, as soon as the
+    most visited root move cannot be overtaken by the playouts left. At
+    least one playout is always run.
+    """
+
+    def __init__(self, n_playout, move_time=None, early_stop=False):
+        """n_playout: None for no limit on the number of playouts, which
+        needs move_time
+        """
+        if n_playout is None and move_time is None:
+            raise ValueError("n_playout=None needs a move_time")
+        self.n_playout = n_playout
+        self.move_time = move_time
+        self.early_stop = early_stop
+        self.n = 0
+        self.stopped_early = False
+        self._start = time.perf_counter()
+
+    def elapsed(self):
+        """Return the seconds since the search started"""
+        return time.perf_counter() - self._start
+
+    def done(self, child_visits):
+        """child_visits: visit counts of the children of the root, or None
+        if it has not been expanded yet
+        """
+        if not self.n:
+            return False
+        if self.n_playout is not None and self.n >= self.n_playout:
+            return True
+        if self.move_time is None and not self.early_stop:
+            return False
+        elapsed = self.elapsed()
+        if self.move_time is not None and elapsed * 1000 >= self.move_time:
+            return True
+        if (self.early_stop and child_visits is not None and
+                len(child_visits) > 1):
+            left = float('inf')
+            if self.n_playout is not None:
+                left = self.n_playout - self.n
+            if self.move_time is not None:
+                # playouts that fit in the time left, at the rate so far
+                left = min(left, self.n * (self.move_time / 1000.0 -
+                                           elapsed) / max(elapsed, 1e-9))
+            second, first = np.partition(child_visits, -2)[-2:]
+            if first - second > left:
+                self.stopped_early = True
+                return True
+        return False
+
+    def info(self):
+        """Return what the search used, for monitoring"""
+        return {'n_playout': self.n,
+                'time': self.elapsed(),
+                'stopped_early': self.stopped_early}
+
+
+class GameClock(object):
+    """Per-game time control: the time left in the game is shared between
+    the moves the player may still have to make, assuming at most half of
+    the empty cells are its own. A new game is detected when the player
+    is asked for a move with fewer than two stones on the board.
+    """
+
+    def __init__(self, game_time):
+        """game_time: milliseconds for all the moves of a game"""
+        self.game_time = game_time
+        self.time_left = game_time
+
+    def move_time(self, board):
+        """Return the milliseconds to spend on the next move"""
+        if len(board.states) < 2:
+            self.time_left = self.game_time
+        n_moves = max(1, (len(board.availables) + 1) // 2)
+        return max(0.0, self.time_left) / n_moves
+
+    def spend(self, seconds):
+        self.time_left -= seconds * 1000
+
+
 class MCTS(object):
     """An implementation of Monte Carlo Tree Search."""
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    # approximate memory taken by one expanded child: the TreeNode, its
+    # entries in the parent's dict and lists, and its slots in the
+    # parent's arrays
+    NODE_BYTES = 450
+    # fraction of the node budget the tree is pruned down to, so that
+    # pruning does not run again on the next playout
+    PRUNE_TO = 0.8
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 n_parallel=1, policy_value_batch_fn=None,
+                 max_nodes=None, max_bytes=None, move_time=None,
+                 early_stop=False, solver=True, stats=None):
         """
         policy_value_fn: a function that takes in a board state and outputs
             a list of (action, probability) tuples and also a score in [-1, 1]
@@ -97,115 +298,960 @@ class MCTS(object):
         c_puct: a number in (0, inf) that controls how quickly exploration
             converges to the maximum-value policy. A higher value means
             relying on the prior more.
+        n_parallel: number of leaves gathered with virtual loss and
+            evaluated together. 1 runs the plain sequential search.
+        policy_value_batch_fn: a function that takes in a list of boards and
+            outputs what policy_value_fn would for each of them, in a single
+            network call. Without it, the leaves of a batch are evaluated
+            one by one with policy_value_fn.
+        max_nodes, max_bytes: budget of the tree, in nodes or approximate
+            bytes (NODE_BYTES per node). When a playout takes the tree over
+            it, the least visited subtrees are collapsed back into leaves.
+            None means unbounded.
+        move_time, early_stop: limits of each search, see SearchLimit.
+            With move_time set, here or for each search, n_playout may be
+            None to search for the whole time.
+        solver: prove wins and losses from the terminal positions found,
+            MCTS-Solver style. A proven node is backed up with its proven
+            value instead of being searched further, and the search stops
+            once the root is proven. A node is only proven a loss by
+            exhaustion when its children cover all the legal moves, so not
+            when candidate windowing drops some of them.
+        stats: a search_stats.SearchStats that records the phase times of
+            the sequential playouts and every search, None to record
+            nothing. The batched playouts of n_parallel > 1 are not
+            timed.
         """
         self._root = TreeNode(None, 1.0)
         self._policy = policy_value_fn
+        self._policy_batch = policy_value_batch_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._n_parallel = n_parallel
+        if max_bytes is not None:
+            max_bytes = max(1, max_bytes // self.NODE_BYTES)
+            max_nodes = max_bytes if max_nodes is None else min(max_nodes,
+                                                                max_bytes)
+        self._max_nodes = max_nodes
+        self._n_nodes = 1
+        self._n_reclaimed = 0
+        self._move_time = move_time
+        self._early_stop = early_stop
+        self._solver = solver
+        self.stats = stats
+        # playouts and time used by the last search
+        self.last_search = None
 
     def _playout(self, state):
         """Run a single playout from the root to the leaf, getting a value at
         the leaf and propagating it back through its parents.
-        State is modified in-place, so a copy must be provided.
+        State is modified in-place and restored with undo_move afterwards.
         """
+        # times the phases into self.stats, or does nothing
+        tick = no_tick if self.stats is None else self.stats.tick
+        tick()
         node = self._root
+        n_moves = 0
         while(1):
-            if node.is_leaf():
+            if node.is_leaf() or node._proven is not None:
                 break
             # Greedily select next move.
             action, node = node.select(self._c_puct)
             state.do_move(action)
+            n_moves += 1
+        tick('select', n_moves)
 
-        # Evaluate the leaf using a network which outputs a list of
-        # (action, probability) tuples p and also a score v in [-1, 1]
-        # for the current player.
-        action_probs, leaf_value = self._policy(state)
-        # Check for end of game.
-        end, winner = state.game_end()
-        if not end:
-            node.expand(action_probs)
+        if node._proven is not None:
+            leaf_value = -node._proven
         else:
-            # for end state，return the "true" leaf_value
-            if winner == -1:  # tie
-                leaf_value = 0.0
+            # Check for end of game before calling the network.
+            end, winner = state.game_end()
+            tick('game_end')
+            if not end:
+                # Evaluate the leaf using a network which outputs a list of
+                # (action, probability) tuples p and also a score v in
+                # [-1, 1] for the current player.
+                action_probs, leaf_value = self._policy(state)
+                tick('inference')
+                self._expand(node, state, action_probs)
+                tick('expand')
             else:
-                leaf_value = (
-                    1.0 if winner == state.get_current_player() else -1.0
-                )
+                leaf_value = self._end_value(node, state, winner)
 
         # Update value and visit count of nodes in this traversal.
         node.update_recursive(-leaf_value)
+        # Walk the state back up to the root position.
+        for i in range(n_moves):
+            state.undo_move()
+        tick('backup')
+        if self._max_nodes is not None and self._n_nodes > self._max_nodes:
+            self._prune()
+            tick('prune')
+
+    def _expand(self, node, state, action_probs):
+        self._n_nodes += node.expand(state.candidate_priors(action_probs))
+        node._complete = len(node._child_nodes) == len(state.availables)
 
-    def get_move_probs(self, state, temp=1e-3):
-        """Run all playouts sequentially and return the available actions and
-        their corresponding probabilities.
+    def _end_value(self, node, state, winner):
+        """Return the value of the end state for the current player, and
+        prove node with it
+        """
+        # for end state，return the "true" leaf_value
+        if winner == -1:  # tie
+            leaf_value = 0.0
+        else:
+            leaf_value = (
+                1.0 if winner == state.get_current_player() else -1.0
+            )
+        if self._solver:
+            node.set_proven(-int(leaf_value))
+            self._prove_parents(node)
+        return leaf_value
+
+    def _prove_parents(self, node):
+        """node was just proven: prove its ancestors that follow from it. A
+        parent is lost for the player who moved into it if any child is a
+        proven win, and otherwise proven once all its moves are proven.
+        """
+        while node._parent is not None:
+            parent = node._parent
+            if node._proven == 1:
+                value = -1
+            elif parent._complete and all(child._proven is not None
+                                          for child in parent._child_nodes):
+                value = -max(child._proven for child in parent._child_nodes)
+            else:
+                return
+            parent.set_proven(value)
+            node = parent
+
+    def _playout_batch(self, state, n_leaves):
+        """Descend up to n_leaves paths from the root, adding a virtual loss
+        along each one so that they spread over the tree, then evaluate the
+        leaves reached in one batch and back them all up. Terminal leaves are
+        backed up right away, and the batch stops early if a path runs into
+        a leaf that is already waiting for its evaluation.
+        Return the number of playouts done.
+        """
+        pending = []  # (leaf, path from the root, copy of the board)
+        pending_nodes = set()
+        n_done = 0
+        for i in range(n_leaves):
+            node = self._root
+            path = [node]
+            while not node.is_leaf() and node._proven is None:
+                action, node = node.select(self._c_puct)
+                state.do_move(action)
+                path.append(node)
+            if node._proven is not None:
+                end, winner = True, None
+            else:
+                end, winner = state.game_end()
+            collided = node in pending_nodes
+            if end:
+                if node._proven is not None:
+                    leaf_value = -node._proven
+                else:
+                    leaf_value = self._end_value(node, state, winner)
+                node.update_recursive(-leaf_value)
+                n_done += 1
+            elif not collided:
+                for path_node in path:
+                    path_node.add_virtual_loss(1)
+                pending.append((node, path, state.clone()))
+                pending_nodes.add(node)
+            for j in range(len(path) - 1):
+                state.undo_move()
+            if collided:
+                break
+
+        if not pending:
+            return n_done
+        boards = [board for node, path, board in pending]
+        if self._policy_batch is not None:
+            results = self._policy_batch(boards)
+        else:
+            results = [self._policy(board) for board in boards]
+        for (node, path, board), (action_probs, leaf_value) in zip(pending,
+                                                                   results):
+            for path_node in path:
+                path_node.add_virtual_loss(-1)
+            self._expand(node, board, action_probs)
+            node.update_recursive(-leaf_value)
+        if self._max_nodes is not None and self._n_nodes > self._max_nodes:
+            self._prune()
+        return n_done + len(pending)
+
+    def _release(self, nodes):
+        """Unlink the subtrees of nodes from their parents, so that they are
+        freed right away rather than by the cycle collector, and count them
+        as reclaimed. Return the number of nodes released.
+        """
+        stack = list(nodes)
+        count = 0
+        while stack:
+            node = stack.pop()
+            node._parent = None
+            stack.extend(node._child_nodes)
+            count += 1
+        self._n_nodes -= count
+        self._n_reclaimed += count
+        return count
+
+    def _prune(self):
+        """Collapse the least visited subtrees into leaves until the tree is
+        down to PRUNE_TO of the budget. A node has more visits than any of
+        its descendants, so subtrees are cut from the bottom up. The root
+        always keeps its children, and so do the proven nodes: the moves
+        that prove them are still needed once one of them becomes the root.
+        """
+        expanded = []
+        stack = list(self._root._child_nodes)
+        while stack:
+            node = stack.pop()
+            if node._child_nodes:
+                if node._proven is None:
+                    expanded.append(node)
+                stack.extend(node._child_nodes)
+        expanded.sort(key=lambda node: node._n_visits)
+        target = int(self._max_nodes * self.PRUNE_TO)
+        for node in expanded:
+            if self._n_nodes <= target:
+                break
+            self._release(node.collapse())
+
+    def get_move_probs(self, state, temp=1e-3, move_time=None,
+                       n_playout=None):
+        """Run the playouts and return the available actions and their
+        corresponding probabilities.
         state: the current game state
         temp: temperature parameter in (0, 1] controls the level of exploration
+        move_time, n_playout: limits of this search, instead of the defaults
         """
-        for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
+        limit = SearchLimit(n_playout if n_playout is not None
+                            else self._n_playout,
+                            move_time if move_time is not None
+                            else self._move_time,
+                            self._early_stop)
+        state_copy = state.clone()
+        if self.stats is not None:
+            self.stats.add('copy', limit.elapsed())
+        root = self._root
+        while not limit.done(root._child_N):
+            if root._proven is not None and root._child_nodes:
+                limit.stopped_early = True
+                break
+            if self._n_parallel > 1:
+                n_leaves = self._n_parallel
+                if limit.n_playout is not None:
+                    n_leaves = min(n_leaves, limit.n_playout - limit.n)
+                limit.n += self._playout_batch(state_copy, n_leaves)
+            else:
+                self._playout(state_copy)
+                limit.n += 1
+        self.last_search = limit.info()
+        if self.stats is not None:
+            self.stats.end_search(limit.n, self.last_search['time'],
+                                  self._root)
+        return self._move_probs(temp)
 
-        # calc the move probabilities based on visit counts at the root node
+    def root_priors(self):
+        """Return the actions at the root and their prior probabilities"""
+        root = self._root
+        return tuple(root._child_actions), root._child_P.copy()
+
+    def _move_probs(self, temp):
+        """calc the move probabilities based on visit counts at the root node.
+        A proven root gets all the probability on its best proven move.
+        """
+        root = self._root
+        if root._proven is not None:
+            values = [(node._proven if node._proven is not None else -2,
+                       node._n_visits) for node in root._child_nodes]
+            best = max(range(len(values)), key=values.__getitem__)
+            act_probs = np.zeros(len(values))
+            act_probs[best] = 1.0
+            return tuple(root._child_actions), act_probs
         act_visits = [(act, node._n_visits)
-                      for act, node in self._root._children.items()]
+                      for act, node in root._children.items()]
         acts, visits = zip(*act_visits)
         act_probs = softmax(1.0/temp * np.log(np.array(visits) + 1e-10))
 
         return acts, act_probs
 
+    def ponder(self, state, stop, max_playouts=None):
+        """Run playouts from state until the threading.Event stop is set,
+        growing the tree for a later get_move_probs on the same position.
+        Pondering also ends after max_playouts playouts, if given, and once
+        the tree fills its node budget, if it has one, rather than pruning
+        it over and over while nobody waits for a move.
+        State is searched in place and restored when this returns.
+        Return the number of playouts done.
+        """
+        n = 0
+        while not stop.is_set():
+            if max_playouts is not None and n >= max_playouts:
+                break
+            if (self._max_nodes is not None and
+                    self._n_nodes >= self._max_nodes):
+                break
+            if self._n_parallel > 1:
+                n += self._playout_batch(state, self._n_parallel)
+            else:
+                self._playout(state)
+                n += 1
+        return n
+
     def update_with_move(self, last_move):
         """Step forward in the tree, keeping everything we already know
         about the subtree.
         """
-        if last_move in self._root._children:
-            self._root = self._root._children[last_move]
+        root = self._root
+        if last_move in root._children:
+            self._root = root._children[last_move]
+            self._release([node for node in root._child_nodes
+                           if node is not self._root])
             self._root._parent = None
+            self._n_nodes -= 1
         else:
+            self._release(root._child_nodes)
             self._root = TreeNode(None, 1.0)
+        # the old root
+        self._n_reclaimed += 1
+
+    def n_nodes(self):
+        """Return the number of nodes in the tree"""
+        return self._n_nodes
+
+    def n_reclaimed(self):
+        """Return the number of nodes dropped from the tree so far, by
+        update_with_move or by pruning
+        """
+        return self._n_reclaimed
 
     def __str__(self):
         return "MCTS"
 
 
+class ThreadedMCTS(MCTS):
+    """MCTS with one tree shared by several search threads. The threads
+    descend with virtual loss, holding the lock of a node while they select
+    from it, expand it or update it; nodes share a fixed set of striped
+    locks. The leaves reached are queued to a single inference thread,
+    which evaluates whatever is waiting in one policy_value_batch_fn call,
+    and each search thread backs up its own leaf when the result is back.
+    A thread reaching a leaf already being evaluated waits for it and
+    carries on below it.
+
+    Numpy and the deep learning backends release the GIL in their heavy
+    math, which is what lets the threads overlap. Pruning for a tree
+    budget is done after each search rather than during it, and the
+    threads do not prove nodes (solver).
+    """
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 n_threads=4, policy_value_batch_fn=None, max_batch=None,
+                 n_locks=64, max_nodes=None, max_bytes=None, move_time=None,
+                 early_stop=False):
+        """
+        n_threads: number of search threads
+        max_batch: most leaves per network call, n_threads by default
+        n_locks: number of locks shared out between the nodes
+        the other arguments are as for MCTS
+        """
+        super(ThreadedMCTS, self).__init__(
+            policy_value_fn, c_puct, n_playout, 1, policy_value_batch_fn,
+            max_nodes, max_bytes, move_time, early_stop)
+        self._n_threads = n_threads
+        self._max_batch = max_batch or n_threads
+        self._locks = [threading.Lock() for i in range(n_locks)]
+        # guards the playout and node counters
+        self._count_lock = threading.Lock()
+        # leaf -> Event set once it is expanded, for the leaves in flight
+        self._pending = {}
+        self._error = None
+
+    def _lock(self, node):
+        return self._locks[(id(node) >> 4) % len(self._locks)]
+
+    def _threaded_playout(self, state, requests):
+        """One playout of a search thread, on its own copy of the board"""
+        node = self._root
+        with self._lock(node):
+            node.add_virtual_loss(1)
+        path = [node]
+        while True:
+            waiting = None
+            with self._lock(node):
+                if node.is_leaf():
+                    waiting = self._pending.get(node)
+                    if waiting is None:
+                        end, winner = state.game_end()
+                        if not end:
+                            self._pending[node] = threading.Event()
+                        break
+                else:
+                    action, child = node.select(self._c_puct)
+                    child.add_virtual_loss(1)
+            if waiting is not None:
+                waiting.wait()
+                if self._error is not None:
+                    break
+                continue
+            state.do_move(action)
+            node = child
+            path.append(node)
+
+        if self._error is not None:
+            leaf_value = None
+        elif end:
+            # for end state，return the "true" leaf_value
+            if winner == -1:  # tie
+                leaf_value = 0.0
+            else:
+                leaf_value = (
+                    1.0 if winner == state.get_current_player() else -1.0
+                )
+        else:
+            request = [state.clone(), time.perf_counter(), None,
+                       threading.Event()]
+            requests.put(request)
+            request[3].wait()
+            leaf_value = None
+            with self._lock(node):
+                try:
+                    if request[2] is not None:
+                        action_probs, leaf_value = request[2]
+                        n_new = node.expand(
+                            state.candidate_priors(action_probs))
+                finally:
+                    # let the threads waiting on this leaf go on
+                    self._pending.pop(node).set()
+            if leaf_value is not None:
+                with self._count_lock:
+                    self._n_nodes += n_new
+
+        if leaf_value is not None:
+            # back up, removing the virtual loss along the path
+            value = -leaf_value
+            for path_node in reversed(path):
+                parent = path_node._parent
+                with self._lock(parent if parent is not None else path_node):
+                    path_node._n_virtual -= 1
+                    path_node.update(value)
+                value = -value
+        for i in range(len(path) - 1):
+            state.undo_move()
+
+    def _search_thread(self, state, limit, requests):
+        try:
+            while True:
+                with self._count_lock:
+                    if (self._error is not None or
+                            limit.done(self._root._child_N)):
+                        return
+                    limit.n += 1
+                self._threaded_playout(state, requests)
+        except Exception as e:
+            self._error = e
+
+    def _inference_thread(self, requests, stats):
+        """Evaluate the queued leaves in batches, until a None request"""
+        stop = False
+        while not stop:
+            batch = [requests.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            stats['n_batches'] += 1
+            stats['n_leaves'] += len(batch)
+            stats['queue_wait'] += sum(start - r[1] for r in batch)
+            if self._error is None:
+                try:
+                    boards = [r[0] for r in batch]
+                    if self._policy_batch is not None:
+                        results = self._policy_batch(boards)
+                    else:
+                        results = [self._policy(board) for board in boards]
+                    for request, result in zip(batch, results):
+                        request[2] = result
+                except Exception as e:
+                    self._error = e
+            for request in batch:
+                request[3].set()
+
+    def get_move_probs(self, state, temp=1e-3, move_time=None,
+                       n_playout=None):
+        """Run the playouts in n_threads threads and return the available
+        actions and their corresponding probabilities, like
+        MCTS.get_move_probs. last_search also reports the number of
+        network calls, the mean batch size, the mean time a leaf waited
+        in the queue and the nodes created per second.
+        """
+        limit = SearchLimit(n_playout if n_playout is not None
+                            else self._n_playout,
+                            move_time if move_time is not None
+                            else self._move_time,
+                            self._early_stop)
+        requests = queue.Queue()
+        stats = {'n_batches': 0, 'n_leaves': 0, 'queue_wait': 0.0}
+        n_nodes = self._n_nodes
+        self._error = None
+        inference = threading.Thread(target=self._inference_thread,
+                                     args=(requests, stats))
+        inference.daemon = True
+        inference.start()
+        threads = [threading.Thread(target=self._search_thread,
+                                    args=(state.clone(), limit, requests))
+                   for i in range(self._n_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        requests.put(None)
+        inference.join()
+        self._pending = {}
+        if self._error is not None:
+            raise self._error
+        n_created = self._n_nodes - n_nodes
+        if self._max_nodes is not None and self._n_nodes > self._max_nodes:
+            self._prune()
+
+        info = limit.info()
+        info['n_batches'] = stats['n_batches']
+        info['mean_batch'] = (float(stats['n_leaves']) /
+                              max(1, stats['n_batches']))
+        info['queue_wait'] = stats['queue_wait'] / max(1, stats['n_leaves'])
+        info['nodes_per_sec'] = n_created / info['time']
+        self.last_search = info
+        return self._move_probs(temp)
+
+    def __str__(self):
+        return "ThreadedMCTS"
+
+
+class ArrayMCTS(object):
+    """Monte Carlo Tree Search like MCTS, with the tree stored as a set of
+    preallocated numpy arrays indexed by node id instead of one TreeNode
+    object per node. The children of a node take a contiguous block of
+    ids, in the order they were expanded, and node 0 is the root. The
+    arrays double in size when full, and update_with_move copies the kept
+    subtree to the front so that the rest is reclaimed.
+    """
+
+    # per node: visit count, Q, prior P, move leading to it, parent id,
+    # id of the first child and number of children
+    _FIELDS = (('_n_visits', np.int32), ('_Q', np.float64),
+               ('_P', np.float64), ('_action', np.int32),
+               ('_parent', np.int32), ('_first_child', np.int32),
+               ('_n_children', np.int32))
+
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 capacity=1024, move_time=None, early_stop=False):
+        """
+        policy_value_fn, c_puct, move_time, early_stop: as for MCTS
+        capacity: number of nodes allocated up front
+        """
+        self._policy = policy_value_fn
+        self._c_puct = c_puct
+        self._n_playout = n_playout
+        self._move_time = move_time
+        self._early_stop = early_stop
+        self.last_search = None
+        for name, dtype in self._FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self._size = 0
+        self._n_reclaimed = 0
+        self._reset_root()
+
+    def _reset_root(self):
+        self._n_reclaimed += self._size
+        self._size = 1
+        self._n_visits[0] = 0
+        self._Q[0] = 0
+        self._P[0] = 1.0
+        self._action[0] = -1
+        self._parent[0] = -1
+        self._n_children[0] = 0
+
+    def _reserve(self, size):
+        """Grow the arrays by doubling until they hold `size` nodes"""
+        capacity = len(self._n_visits)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, dtype in self._FIELDS:
+            array = np.zeros(capacity, dtype=dtype)
+            array[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, array)
+
+    def _expand(self, node, action_priors):
+        action_priors = list(action_priors)
+        k = len(action_priors)
+        first = self._size
+        self._reserve(first + k)
+        last = first + k
+        if k:
+            actions, priors = zip(*action_priors)
+            self._action[first:last] = actions
+            self._P[first:last] = priors
+        self._n_visits[first:last] = 0
+        self._Q[first:last] = 0
+        self._parent[first:last] = node
+        self._n_children[first:last] = 0
+        self._first_child[node] = first
+        self._n_children[node] = k
+        self._size = last
+
+    def _select(self, node):
+        """Return the child of node with the largest Q plus bonus u(P),
+        the first one in expansion order on ties, like TreeNode.select
+        """
+        first = self._first_child[node]
+        last = first + self._n_children[node]
+        n_visits = self._n_visits[first:last]
+        values = self._Q[first:last] + (
+            self._c_puct * self._P[first:last] *
+            np.sqrt(self._n_visits[node]) / (1 + n_visits))
+        return first + int(np.argmax(values))
+
+    def _backup(self, node, leaf_value):
+        """Update the nodes from `node` up to the root, flipping the sign
+        of the value at every level
+        """
+        while node != -1:
+            self._n_visits[node] += 1
+            self._Q[node] += 1.0*(leaf_value - self._Q[node]) / \
+                self._n_visits[node]
+            leaf_value = -leaf_value
+            node = int(self._parent[node])
+
+    def _playout(self, state):
+        """Run a single playout from the root to the leaf, getting a value at
+        the leaf and propagating it back through its parents.
+        State is modified in-place and restored with undo_move afterwards.
+        """
+        node = 0
+        n_moves = 0
+        while self._n_children[node]:
+            node = self._select(node)
+            state.do_move(int(self._action[node]))
+            n_moves += 1
+
+        end, winner = state.game_end()
+        if not end:
+            action_probs, leaf_value = self._policy(state)
+            self._expand(node, state.candidate_priors(action_probs))
+        else:
+            # for end state，return the "true" leaf_value
+            if winner == -1:  # tie
+                leaf_value = 0.0
+            else:
+                leaf_value = (
+                    1.0 if winner == state.get_current_player() else -1.0
+                )
+        self._backup(node, -leaf_value)
+        for i in range(n_moves):
+            state.undo_move()
+
+    def get_move_probs(self, state, temp=1e-3, move_time=None,
+                       n_playout=None):
+        """Run the playouts sequentially and return the available actions and
+        their corresponding probabilities, like MCTS.get_move_probs
+        """
+        state_copy = state.clone()
+        limit = SearchLimit(n_playout if n_playout is not None
+                            else self._n_playout,
+                            move_time if move_time is not None
+                            else self._move_time,
+                            self._early_stop)
+        while not limit.done(self._root_visits()):
+            self._playout(state_copy)
+            limit.n += 1
+        self.last_search = limit.info()
+
+        first = self._first_child[0]
+        last = first + self._n_children[0]
+        acts = tuple(self._action[first:last].tolist())
+        visits = self._n_visits[first:last]
+        act_probs = softmax(1.0/temp * np.log(visits + 1e-10))
+        return acts, act_probs
+
+    def root_priors(self):
+        """Return the actions at the root and their prior probabilities"""
+        first = self._first_child[0]
+        last = first + self._n_children[0]
+        return (tuple(self._action[first:last].tolist()),
+                self._P[first:last].copy())
+
+    def _root_visits(self):
+        """Return the visit counts of the children of the root, or None"""
+        if not self._n_children[0]:
+            return None
+        first = self._first_child[0]
+        return self._n_visits[first:first + self._n_children[0]]
+
+    def ponder(self, state, stop, max_playouts=None):
+        """Run playouts from state until stop is set or max_playouts are
+        done, like MCTS.ponder
+        """
+        n = 0
+        while not stop.is_set():
+            if max_playouts is not None and n >= max_playouts:
+                break
+            self._playout(state)
+            n += 1
+        return n
+
+    def update_with_move(self, last_move):
+        """Step forward in the tree, keeping everything we already know
+        about the subtree, which is moved to the front of the arrays.
+        """
+        first = self._first_child[0]
+        children = self._action[first:first + self._n_children[0]]
+        index = np.flatnonzero(children == last_move)
+        if not len(index):
+            self._reset_root()
+            return
+        old = {name: getattr(self, name).copy() for name, dtype in self._FIELDS}
+        node = first + int(index[0])
+        for name, dtype in self._FIELDS:
+            getattr(self, name)[0] = old[name][node]
+        self._parent[0] = -1
+        # copy the child blocks breadth first, old id -> new id
+        queue = [(node, 0)]
+        size = 1
+        for old_node, new_node in queue:
+            k = old['_n_children'][old_node]
+            if not k:
+                continue
+            old_first = old['_first_child'][old_node]
+            for name, dtype in self._FIELDS:
+                getattr(self, name)[size:size + k] = \
+                    old[name][old_first:old_first + k]
+            self._parent[size:size + k] = new_node
+            self._first_child[new_node] = size
+            expanded = np.flatnonzero(old['_n_children'][old_first:
+                                                         old_first + k])
+            queue.extend((old_first + i, size + i) for i in expanded)
+            size += k
+        self._n_reclaimed += self._size - size
+        self._size = size
+
+    def n_nodes(self):
+        """Return the number of nodes in the tree"""
+        return self._size
+
+    def n_reclaimed(self):
+        """Return the number of nodes dropped by update_with_move so far"""
+        return self._n_reclaimed
+
+    def __str__(self):
+        return "ArrayMCTS"
+
+
 class MCTSPlayer(object):
     """AI player based on MCTS"""
 
     def __init__(self, policy_value_function,
-                 c_puct=5, n_playout=2000, is_selfplay=0):
-        self.mcts = MCTS(policy_value_function, c_puct, n_playout)
+                 c_puct=5, n_playout=2000, is_selfplay=0, array_tree=0,
+                 n_parallel=1, policy_value_batch_fn=None,
+                 max_nodes=None, max_bytes=None, move_time=None,
+                 game_time=None, early_stop=False, n_workers=1, n_threads=1,
+                 full_search_prob=1.0, n_playout_fast=None, stats=False):
+        """
+        array_tree: search with ArrayMCTS instead of MCTS
+        n_parallel, policy_value_batch_fn: batched leaf evaluation, see MCTS
+        max_nodes, max_bytes: budget of the search tree, see MCTS
+        move_time: milliseconds per move
+        game_time: milliseconds per game, shared out by a GameClock
+        early_stop: end a search once its best move is decided
+        n_workers: split the playouts between this many processes, each
+            with its own tree, see mcts_parallel.RootParallelMCTS
+        n_threads: search one shared tree with this many threads, see
+            ThreadedMCTS
+        full_search_prob, n_playout_fast: playout cap randomization in
+            self-play. Each move gets the full n_playout search with
+            probability full_search_prob, and otherwise a fast search of
+            n_playout_fast playouts, without Dirichlet noise, whose pi is
+            only the root prior: such moves are meant as value targets
+            only, and full_search tells which kind the last move was.
+        stats: record the searches in a search_stats.SearchStats, read
+            from self.stats after each get_action. Only the plain MCTS
+            search supports it.
+        """
+        if n_playout is None and move_time is None and game_time is None:
+            raise ValueError("n_playout=None needs move_time or game_time")
+        if full_search_prob < 1 and n_playout_fast is None:
+            raise ValueError("full_search_prob < 1 needs n_playout_fast")
+        self.stats = SearchStats() if stats else None
+        if stats and (n_threads > 1 or n_workers > 1 or array_tree or
+                      n_parallel > 1):
+            raise ValueError("search stats need the plain MCTS search")
+        if n_threads > 1:
+            if array_tree or n_parallel > 1 or n_workers > 1:
+                raise ValueError("threaded search does not combine with "
+                                 "array_tree, n_parallel or n_workers")
+            self.mcts = ThreadedMCTS(policy_value_function, c_puct,
+                                     n_playout, n_threads,
+                                     policy_value_batch_fn,
+                                     max_nodes=max_nodes,
+                                     max_bytes=max_bytes,
+                                     move_time=move_time,
+                                     early_stop=early_stop)
+        elif n_workers > 1:
+            if (array_tree or n_parallel > 1 or max_nodes or max_bytes or
+                    full_search_prob < 1):
+                raise ValueError("root-parallel search only supports the "
+                                 "plain MCTS options")
+            self.mcts = RootParallelMCTS(MCTS, policy_value_function,
+                                         c_puct, n_playout, n_workers,
+                                         move_time=move_time,
+                                         early_stop=early_stop)
+        elif array_tree:
+            if n_parallel > 1 or max_nodes or max_bytes:
+                raise ValueError("batched search and tree budgets "
+                                 "need array_tree=0")
+            self.mcts = ArrayMCTS(policy_value_function, c_puct, n_playout,
+                                  move_time=move_time, early_stop=early_stop)
+        else:
+            self.mcts = MCTS(policy_value_function, c_puct, n_playout,
+                             n_parallel, policy_value_batch_fn,
+                             max_nodes, max_bytes, move_time, early_stop,
+                             stats=self.stats)
+        self._clock = GameClock(game_time) if game_time is not None else None
+        # playouts and time used by the last get_action
+        self.last_search = None
         self._is_selfplay = is_selfplay
+        self._full_search_prob = full_search_prob
+        self._n_playout_fast = n_playout_fast
+        # whether the last move got a full search
+        self.full_search = True
+        # zobrist hash of the position at the root of the search tree
+        self._root_hash = None
+        self._ponder_thread = None
+        self._ponder_stop = None
 
     def set_player_ind(self, p):
         self.player = p
 
     def reset_player(self):
+        self.stop_pondering()
         self.mcts.update_with_move(-1)
+        self._root_hash = None
+
+    def close(self):
+        """Stop pondering and shut down the worker processes of a
+        root-parallel search. The player cannot search afterwards.
+        """
+        self.stop_pondering()
+        if isinstance(self.mcts, RootParallelMCTS):
+            self.mcts.close()
+
+    def _sync_tree(self, board):
+        """Bring the root of the search tree to the position on board: keep
+        the tree if it is already there, step into the subtree of the last
+        move if the tree is one move behind (the opponent's reply), and
+        start a new tree otherwise.
+        """
+        key = board.zobrist_hash()
+        if key == self._root_hash:
+            return
+        if self._root_hash is not None and board.last_move != -1:
+            previous = board.clone()
+            previous.undo_move()
+            if previous.zobrist_hash() == self._root_hash:
+                self.mcts.update_with_move(board.last_move)
+                self._root_hash = key
+                return
+        self.mcts.update_with_move(-1)
+        self._root_hash = key
+
+    def start_pondering(self, board, max_playouts=None):
+        """Keep searching the position on board in a background thread,
+        typically while the opponent thinks, until stop_pondering, the
+        next get_action, max_playouts playouts or a full tree budget
+        (max_nodes/max_bytes). If the opponent then plays a move the search
+        has explored, its subtree is reused. A root-parallel player keeps
+        no tree between moves, so it does not ponder.
+        """
+        self.stop_pondering()
+        if isinstance(self.mcts, RootParallelMCTS):
+            return
+        self._sync_tree(board)
+        self._ponder_stop = threading.Event()
+        self._ponder_thread = threading.Thread(
+            target=self.mcts.ponder,
+            args=(board.clone(), self._ponder_stop, max_playouts))
+        self._ponder_thread.daemon = True
+        self._ponder_thread.start()
+
+    def stop_pondering(self):
+        """Stop the background search, if any, and wait for it to finish"""
+        if self._ponder_thread is not None:
+            self._ponder_stop.set()
+            self._ponder_thread.join()
+            self._ponder_thread = None
+            self._ponder_stop = None
 
     def get_action(self, board, temp=1e-3, return_prob=0):
+        self.stop_pondering()
         sensible_moves = board.availables
         # the pi vector returned by MCTS as in the alphaGo Zero paper
         move_probs = np.zeros(board.width*board.height)
         if len(sensible_moves) > 0:
-            acts, probs = self.mcts.get_move_probs(board, temp)
-            move_probs[list(acts)] = probs
-            if self._is_selfplay:
+            self._sync_tree(board)
+            move_time = None
+            if self._clock is not None:
+                move_time = self._clock.move_time(board)
+            self.full_search = True
+            n_playout = None
+            if self._is_selfplay and self._full_search_prob < 1:
+                self.full_search = np.random.rand() < self._full_search_prob
+                if not self.full_search:
+                    n_playout = self._n_playout_fast
+            acts, probs = self.mcts.get_move_probs(board, temp, move_time,
+                                                   n_playout)
+            self.last_search = self.mcts.last_search
+            if self._clock is not None:
+                self._clock.spend(self.last_search['time'])
+            if self.full_search:
+                move_probs[list(acts)] = probs
+            else:
+                # no policy target: the network's own prior stands in
+                prior_acts, priors = self.mcts.root_priors()
+                move_probs[list(prior_acts)] = priors / np.sum(priors)
+            if self._is_selfplay and not self.full_search:
+                move = np.random.choice(acts, p=probs)
+            elif self._is_selfplay:
                 # add Dirichlet Noise for exploration (needed for
                 # self-play training)
                 move = np.random.choice(
                     acts,
                     p=0.75*probs + 0.25*np.random.dirichlet(0.3*np.ones(len(probs)))
                 )
-                # update the root node and reuse the search tree
-                self.mcts.update_with_move(move)
             else:
                 # with the default temp=1e-3, it is almost equivalent
                 # to choosing the move with the highest prob
                 move = np.random.choice(acts, p=probs)
-                # reset the root node
-                self.mcts.update_with_move(-1)
 #                location = board.move_to_location(move)
 #                print("AI move: %d,%d\n" % (location[0], location[1]))
+            # update the root node and reuse the search tree, for the next
+            # move in self-play or for the opponent's reply otherwise
+            self.mcts.update_with_move(move)
+            after = board.clone()
+            after.do_move(move)
+            self._root_hash = after.zobrist_hash()
 
             if return_prob:
                 return move, move_probs
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Root-parallel Monte Carlo Tree Search: several worker processes each build
+an independent tree from the same root, with their own random seed and
+root noise, for a share of the playouts. The visit counts at the root are
+summed before a move is picked.
+
+The workers are started once, with the policy function, and kept for all
+the moves. Set OMP_NUM_THREADS=1 (or the equivalent for the BLAS in use)
+so that the workers do not compete for the cores inside numpy.
+"""
+
+from __future__ import print_function
+import multiprocessing
+import time
+import numpy as np
+
+# policy of the worker process, set by _init_worker
+_worker_policy = None
+
+
+def _init_worker(policy_value_fn):
+    global _worker_policy
+    _worker_policy = policy_value_fn
+
+
+def _noisy_root_policy(policy_value_fn, noise, rng):
+    """Wrap policy_value_fn so that the first call, which evaluates the root
+    of a new tree, mixes Dirichlet noise into the priors
+    """
+    calls = [0]
+
+    def policy(board):
+        action_probs, value = policy_value_fn(board)
+        if calls[0] == 0:
+            action_probs = list(action_probs)
+            if action_probs:
+                acts, probs = zip(*action_probs)
+                probs = ((1 - noise) * np.array(probs) +
+                         noise * rng.dirichlet(0.3 * np.ones(len(probs))))
+                action_probs = list(zip(acts, probs))
+        calls[0] += 1
+        return action_probs, value
+    return policy
+
+
+def _search(args):
+    """Build one tree in a worker, return its root visits and search info"""
+    (mcts_class, c_puct, n_playout, move_time, early_stop, noise, seed,
+     board) = args
+    np.random.seed(seed)
+    policy = _worker_policy
+    if noise:
+        policy = _noisy_root_policy(policy, noise, np.random.RandomState(seed))
+    mcts = mcts_class(policy, c_puct, n_playout, move_time=move_time,
+                      early_stop=early_stop)
+    if hasattr(mcts, 'get_move_probs'):
+        mcts.get_move_probs(board)
+    else:
+        mcts.get_move(board)
+    # both engines keep TreeNode objects at the root
+    children = mcts._root._children
+    return (list(children.keys()),
+            [node._n_visits for node in children.values()],
+            mcts.last_search)
+
+
+class RootParallelMCTS(object):
+    """Drop-in replacement for mcts_alphaZero.MCTS and mcts_pure.MCTS that
+    runs the search in a pool of worker processes. The trees are not kept
+    between moves, so update_with_move does nothing.
+    """
+
+    def __init__(self, mcts_class, policy_value_fn, c_puct=5,
+                 n_playout=10000, n_workers=2, noise=0.25, move_time=None,
+                 early_stop=False):
+        """
+        mcts_class: the tree search run by each worker, mcts_alphaZero.MCTS
+            or mcts_pure.MCTS
+        policy_value_fn: passed to mcts_class in every worker. It is sent to
+            the workers once, so it must be picklable unless the processes
+            are forked (the default on Linux).
+        n_playout: total over all workers, None for a time-limited search
+        noise: weight of the Dirichlet noise mixed into the root priors of
+            every worker but the first, to spread the trees apart
+        move_time, early_stop: limits of the search of each worker
+        """
+        self._mcts_class = mcts_class
+        self._c_puct = c_puct
+        self._n_playout = n_playout
+        self._n_workers = n_workers
+        self._noise = noise
+        self._move_time = move_time
+        self._early_stop = early_stop
+        self._pool = multiprocessing.Pool(n_workers, _init_worker,
+                                          (policy_value_fn,))
+        # playouts and time used by the last search
+        self.last_search = None
+
+    def _playout_shares(self, n_playout):
+        if n_playout is None:
+            return [None] * self._n_workers
+        share, extra = divmod(n_playout, self._n_workers)
+        return [max(1, share + (i < extra)) for i in range(self._n_workers)]
+
+    def _root_visits(self, state, move_time, n_playout):
+        """Search in all workers, return the merged (acts, visits)"""
+        start = time.perf_counter()
+        if move_time is None:
+            move_time = self._move_time
+        if n_playout is None:
+            n_playout = self._n_playout
+        if n_playout is None and move_time is None:
+            raise ValueError("n_playout=None needs a move_time")
+        seeds = np.random.randint(2 ** 31, size=self._n_workers)
+        jobs = [(self._mcts_class, self._c_puct, share, move_time,
+                 self._early_stop, self._noise if i else 0.0, seed, state)
+                for i, (share, seed) in enumerate(
+                    zip(self._playout_shares(n_playout), seeds))]
+        visits = {}
+        n_playout = 0
+        for acts, counts, info in self._pool.map(_search, jobs):
+            for act, count in zip(acts, counts):
+                visits[act] = visits.get(act, 0) + count
+            n_playout += info['n_playout']
+        self.last_search = {'n_playout': n_playout,
+                            'time': time.perf_counter() - start,
+                            'stopped_early': False,
+                            'n_workers': self._n_workers}
+        acts = sorted(visits)
+        return acts, np.array([visits[act] for act in acts], dtype=float)
+
+    def get_move_probs(self, state, temp=1e-3, move_time=None,
+                       n_playout=None):
+        """Like mcts_alphaZero.MCTS.get_move_probs, on the merged visits"""
+        acts, visits = self._root_visits(state, move_time, n_playout)
+        logits = 1.0/temp * np.log(visits + 1e-10)
+        act_probs = np.exp(logits - np.max(logits))
+        act_probs /= np.sum(act_probs)
+        return tuple(acts), act_probs
+
+    def get_move(self, state, move_time=None):
+        """Like mcts_pure.MCTS.get_move: the most visited merged action"""
+        acts, visits = self._root_visits(state, move_time, None)
+        return acts[int(np.argmax(visits))]
+
+    def update_with_move(self, last_move):
+        pass
+
+    def close(self):
+        """Shut down the worker processes"""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __str__(self):
+        return "RootParallelMCTS"
@@ -6,97 +6,28 @@ A pure implementation of the Monte Carlo Tree Search (MCTS)
 """
 
 import numpy as np
-import copy
-from operator import itemgetter
-
-
-def rollout_policy_fn(board):
-    """a coarse, fast version of policy_fn used in the rollout phase."""
-    # rollout randomly
-    action_probs = np.random.rand(len(board.availables))
-    return zip(board.availables, action_probs)
+from mcts_alphaZero import TreeNode, SearchLimit, GameClock
+from mcts_parallel import RootParallelMCTS
+from rollout import random_rollout, batch_rollout
+from search_stats import SearchStats, no_tick
 
 
 def policy_value_fn(board):
     """a function that takes in a state and outputs a list of (action, probability)
     tuples and a score for the state"""
-    # return uniform probabilities and 0 score for pure MCTS
-    action_probs = np.ones(len(board.availables))/len(board.availables)
-    return zip(board.availables, action_probs), 0
-
-
-class TreeNode(object):
-    """A node in the MCTS tree. Each node keeps track of its own value Q,
-    prior probability P, and its visit-count-adjusted prior score u.
-    """
-
-    def __init__(self, parent, prior_p):
-        self._parent = parent
-        self._children = {}  # a map from action to TreeNode
-        self._n_visits = 0
-        self._Q = 0
-        self._u = 0
-        self._P = prior_p
-
-    def expand(self, action_priors):
-        """Expand tree by creating new children.
-        action_priors: a list of tuples of actions and their prior probability
-            according to the policy function.
-        """
-        for action, prob in action_priors:
-            if action not in self._children:
-                self._children[action] = TreeNode(self, prob)
-
-    def select(self, c_puct):
-        """Select action among children that gives maximum action value Q
-        plus bonus u(P).
-        Return: A tuple of (action, next_node)
-        """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
-
-    def update(self, leaf_value):
-        """Update node values from leaf evaluation.
-        leaf_value: the value of subtree evaluation from the current player's
-            perspective.
-        """
-        # Count visit.
-        self._n_visits += 1
-        # Update Q, a running average of values for all visits.
-        self._Q += 1.0*(leaf_value - self._Q) / self._n_visits
-
-    def update_recursive(self, leaf_value):
-        """Like a call to update(), but applied recursively for all ancestors.
-        """
-        # If it is not root, this node's parent should be updated first.
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
-
-    def get_value(self, c_puct):
-        """Calculate and return the value for this node.
-        It is a combination of leaf evaluations Q, and this node's prior
-        adjusted for its visit count, u.
-        c_puct: a number in (0, inf) controlling the relative impact of
-            value Q, and prior probability P, on this node's score.
-        """
-        self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
-
-    def is_leaf(self):
-        """Check if leaf node (i.e. no nodes below this have been expanded).
-        """
-        return self._children == {}
-
-    def is_root(self):
-        return self._parent is None
+    # return uniform probabilities over the candidate moves and 0 score
+    # for pure MCTS
+    moves = board.candidate_moves()
+    action_probs = np.ones(len(moves))/len(moves)
+    return zip(moves, action_probs), 0
 
 
 class MCTS(object):
     """A simple implementation of Monte Carlo Tree Search."""
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000,
+                 move_time=None, early_stop=False, stats=None, n_rollouts=1,
+                 rollout_policy=random_rollout):
         """
         policy_value_fn: a function that takes in a board state and outputs
             a list of (action, probability) tuples and also a score in [-1, 1]
@@ -105,18 +36,38 @@ class MCTS(object):
         c_puct: a number in (0, inf) that controls how quickly exploration
             converges to the maximum-value policy. A higher value means
             relying on the prior more.
+        move_time, early_stop: limits of each search, see
+            mcts_alphaZero.SearchLimit
+        stats: a search_stats.SearchStats recording the phase times of the
+            playouts and every search, None to record nothing
+        n_rollouts: games played out from each leaf, whose mean result is
+            backed up. With the random rollout policy they are played in
+            one rollout.batch_rollout call.
+        rollout_policy: a function that plays a board out and returns the
+            winner, e.g. rollout.random_rollout or rollout.heuristic_rollout
         """
         self._root = TreeNode(None, 1.0)
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._move_time = move_time
+        self._early_stop = early_stop
+        self.stats = stats
+        self._n_rollouts = n_rollouts
+        self._rollout = rollout_policy
+        # playouts and time used by the last search
+        self.last_search = None
 
     def _playout(self, state):
         """Run a single playout from the root to the leaf, getting a value at
         the leaf and propagating it back through its parents.
-        State is modified in-place, so a copy must be provided.
+        State is modified in-place and restored with undo_move afterwards.
         """
+        # times the phases into self.stats, or does nothing
+        tick = no_tick if self.stats is None else self.stats.tick
+        tick()
         node = self._root
+        n_moves = 0
         while(1):
             if node.is_leaf():
 
@@ -124,47 +75,69 @@ class MCTS(object):
             # Greedily select next move.
             action, node = node.select(self._c_puct)
             state.do_move(action)
+            n_moves += 1
+        tick('select', n_moves)
 
         action_probs, _ = self._policy(state)
+        tick('inference')
         # Check for end of game
         end, winner = state.game_end()
+        tick('game_end')
         if not end:
-            node.expand(action_probs)
+            node.expand(state.candidate_priors(action_probs))
+            tick('expand')
         # Evaluate the leaf node by random rollout
         leaf_value = self._evaluate_rollout(state)
+        tick('rollout')
         # Update value and visit count of nodes in this traversal.
         node.update_recursive(-leaf_value)
+        # Walk the state back up to the root position.
+        for i in range(n_moves):
+            state.undo_move()
+        tick('backup')
 
-    def _evaluate_rollout(self, state, limit=1000):
+    def _evaluate_rollout(self, state):
         """Use the rollout policy to play until the end of the game,
         returning +1 if the current player wins, -1 if the opponent wins,
-        and 0 if it is a tie.
+        and 0 if it is a tie, or the mean of that over n_rollouts games.
+        State is left unchanged.
         """
         player = state.get_current_player()
-        for i in range(limit):
-            end, winner = state.game_end()
-            if end:
-                break
-            action_probs = rollout_policy_fn(state)
-            max_action = max(action_probs, key=itemgetter(1))[0]
-            state.do_move(max_action)
-        else:
-            # If no break from the loop, issue a warning.
-            print("WARNING: rollout reached move limit")
+        if self._n_rollouts > 1:
+            if self._rollout is random_rollout:
+                winners = batch_rollout(state, self._n_rollouts)
+            else:
+                winners = np.array([self._rollout(state)
+                                    for i in range(self._n_rollouts)])
+            return (np.mean(winners == player) -
+                    np.mean((winners != player) & (winners != -1)))
+        winner = self._rollout(state)
         if winner == -1:  # tie
             return 0
         else:
             return 1 if winner == player else -1
 
-    def get_move(self, state):
-        """Runs all playouts sequentially and returns the most visited action.
+    def get_move(self, state, move_time=None):
+        """Runs the playouts sequentially and returns the most visited action.
         state: the current game state
+        move_time: milliseconds for this search, instead of the default
 
         Return: the selected action
         """
-        for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
+        limit = SearchLimit(self._n_playout,
+                            move_time if move_time is not None
+                            else self._move_time,
+                            self._early_stop)
+        state_copy = state.clone()
+        if self.stats is not None:
+            self.stats.add('copy', limit.elapsed())
+        while not limit.done(self._root._child_N):
             self._playout(state_copy)
+            limit.n += 1
+        self.last_search = limit.info()
+        if self.stats is not None:
+            self.stats.end_search(limit.n, self.last_search['time'],
+                                  self._root)
         return max(self._root._children.items(),
                    key=lambda act_node: act_node[1]._n_visits)[0]
 
@@ -184,8 +157,32 @@ class MCTS(object):
 
 class MCTSPlayer(object):
     """AI player based on MCTS"""
-    def __init__(self, c_puct=5, n_playout=2000):
-        self.mcts = MCTS(policy_value_fn, c_puct, n_playout)
+    def __init__(self, c_puct=5, n_playout=2000, move_time=None,
+                 game_time=None, early_stop=False, n_workers=1, stats=False,
+                 n_rollouts=1, rollout_policy=random_rollout):
+        """move_time, game_time, early_stop, n_workers, stats: as for
+        mcts_alphaZero.MCTSPlayer
+        n_rollouts, rollout_policy: how the leaves are played out, see MCTS
+        """
+        if n_playout is None and move_time is None and game_time is None:
+            raise ValueError("n_playout=None needs move_time or game_time")
+        self.stats = SearchStats() if stats else None
+        if n_workers > 1 and (stats or n_rollouts > 1 or
+                              rollout_policy is not random_rollout):
+            raise ValueError("search stats and rollout options need the "
+                             "single process search")
+        if n_workers > 1:
+            self.mcts = RootParallelMCTS(MCTS, policy_value_fn, c_puct,
+                                         n_playout, n_workers,
+                                         move_time=move_time,
+                                         early_stop=early_stop)
+        else:
+            self.mcts = MCTS(policy_value_fn, c_puct, n_playout, move_time,
+                             early_stop, self.stats, n_rollouts,
+                             rollout_policy)
+        self._clock = GameClock(game_time) if game_time is not None else None
+        # playouts and time used by the last get_action
+        self.last_search = None
 
     def set_player_ind(self, p):
         self.player = p
@@ -193,10 +190,23 @@ class MCTSPlayer(object):
     def reset_player(self):
         self.mcts.update_with_move(-1)
 
+    def close(self):
+        """Shut down the worker processes of a root-parallel search. The
+        player cannot search afterwards.
+        """
+        if isinstance(self.mcts, RootParallelMCTS):
+            self.mcts.close()
+
     def get_action(self, board):
         sensible_moves = board.availables
         if len(sensible_moves) > 0:
-            move = self.mcts.get_move(board)
+            move_time = None
+            if self._clock is not None:
+                move_time = self._clock.move_time(board)
+            move = self.mcts.get_move(board, move_time)
+            self.last_search = self.mcts.last_search
+            if self._clock is not None:
+                self._clock.spend(self.last_search['time'])
             self.mcts.update_with_move(-1)
             return move
         else:
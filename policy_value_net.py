@@ -10,6 +10,8 @@ import theano
 import theano.tensor as T
 import lasagne
 import pickle
+import numpy as np
+from game import batch_policy_value
 
 
 class PolicyValueNet():
@@ -82,6 +84,10 @@ class PolicyValueNet():
         act_probs = zip(legal_positions, act_probs.flatten()[legal_positions])
         return act_probs, value[0][0]
 
+    def policy_value_batch_fn(self, boards):
+        """policy_value_fn for a list of boards, in a single batch"""
+        return batch_policy_value(self.policy_value, boards)
+
     def _loss_train_op(self):
         """
         Three loss terms：
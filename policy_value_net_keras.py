@@ -22,6 +22,7 @@ from keras.utils import np_utils
 
 import numpy as np
 import pickle
+from game import batch_policy_value
 
 
 class PolicyValueNet():
@@ -74,6 +75,10 @@ class PolicyValueNet():
         act_probs = zip(legal_positions, act_probs.flatten()[legal_positions])
         return act_probs, value[0][0]
 
+    def policy_value_batch_fn(self, boards):
+        """policy_value_fn for a list of boards, in a single batch"""
+        return batch_policy_value(self.policy_value, boards)
+
     def _loss_train_op(self):
         """
         Three loss terms：
@@ -8,6 +8,7 @@ trained AI model without installing any DL framwork
 
 from __future__ import print_function
 import numpy as np
+from game import batch_policy_value
 
 
 # some utility functions
@@ -89,27 +90,41 @@ class PolicyValueNetNumpy():
         self.board_height = board_height
         self.params = net_params
 
-    def policy_value_fn(self, board):
+    def policy_value(self, state_batch):
         """
-        input: board
-        output: a list of (action, probability) tuples for each available
-        action and the score of the board state
+        input: a batch of states
+        output: a batch of action probabilities and state values
         """
-        legal_positions = board.availables
-        current_state = board.current_state()
-
-        X = current_state.reshape(-1, 4, self.board_width, self.board_height)
+        X = np.asarray(state_batch).reshape(
+            -1, 4, self.board_width, self.board_height)
+        n = X.shape[0]
         # first 3 conv layers with ReLu nonlinearity
         for i in [0, 2, 4]:
             X = relu(conv_forward(X, self.params[i], self.params[i+1]))
         # policy head
         X_p = relu(conv_forward(X, self.params[6], self.params[7], padding=0))
-        X_p = fc_forward(X_p.flatten(), self.params[8], self.params[9])
-        act_probs = softmax(X_p)
+        X_p = fc_forward(X_p.reshape(n, -1), self.params[8], self.params[9])
+        act_probs = np.exp(X_p - np.max(X_p, axis=1, keepdims=True))
+        act_probs /= np.sum(act_probs, axis=1, keepdims=True)
         # value head
         X_v = relu(conv_forward(X, self.params[10],
                                 self.params[11], padding=0))
-        X_v = relu(fc_forward(X_v.flatten(), self.params[12], self.params[13]))
-        value = np.tanh(fc_forward(X_v, self.params[14], self.params[15]))[0]
-        act_probs = zip(legal_positions, act_probs.flatten()[legal_positions])
+        X_v = relu(fc_forward(X_v.reshape(n, -1),
+                              self.params[12], self.params[13]))
+        value = np.tanh(fc_forward(X_v, self.params[14], self.params[15]))
         return act_probs, value
+
+    def policy_value_fn(self, board):
+        """
+        input: board
+        output: a list of (action, probability) tuples for each available
+        action and the score of the board state
+        """
+        legal_positions = board.availables
+        act_probs, value = self.policy_value(board.current_state())
+        act_probs = zip(legal_positions, act_probs[0][legal_positions])
+        return act_probs, value[0][0]
+
+    def policy_value_batch_fn(self, boards):
+        """policy_value_fn for a list of boards, in a single batch"""
+        return batch_policy_value(self.policy_value, boards)
@@ -12,6 +12,7 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
+from game import batch_policy_value
 
 
 def set_learning_rate(optimizer, lr):
@@ -72,6 +73,9 @@ class PolicyValueNet():
             self.policy_value_net = Net(board_width, board_height)
         self.optimizer = optim.Adam(self.policy_value_net.parameters(),
                                     weight_decay=self.l2_const)
+        # input buffer for policy_value_fn, filled by board.current_state
+        self._state_buffer = np.empty((1, 4, board_height, board_width),
+                                      dtype=np.float32)
 
         if model_file:
             net_params = torch.load(model_file)
@@ -100,8 +104,8 @@ class PolicyValueNet():
         action and the score of the board state
         """
         legal_positions = board.availables
-        current_state = np.ascontiguousarray(board.current_state().reshape(
-                -1, 4, self.board_width, self.board_height))
+        current_state = self._state_buffer
+        board.current_state(out=current_state[0])
         if self.use_gpu:
             log_act_probs, value = self.policy_value_net(
                     Variable(torch.from_numpy(current_state)).cuda().float())
@@ -115,6 +119,10 @@ class PolicyValueNet():
         act_probs = zip(legal_positions, act_probs[legal_positions])
         return act_probs, value
 
+    def policy_value_batch_fn(self, boards):
+        """policy_value_fn for a list of boards, in a single batch"""
+        return batch_policy_value(self.policy_value, boards)
+
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         """perform a training step"""
         # wrap in Variable
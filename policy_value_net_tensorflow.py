@@ -8,6 +8,7 @@ Tested in Tensorflow 1.4 and 1.5
 
 import numpy as np
 import tensorflow as tf
+from game import batch_policy_value
 
 
 class PolicyValueNet():
@@ -127,6 +128,10 @@ class PolicyValueNet():
         act_probs = zip(legal_positions, act_probs[0][legal_positions])
         return act_probs, value
 
+    def policy_value_batch_fn(self, boards):
+        """policy_value_fn for a list of boards, in a single batch"""
+        return batch_policy_value(self.policy_value, boards)
+
     def train_step(self, state_batch, mcts_probs, winner_batch, lr):
         """perform a training step"""
         winner_batch = np.reshape(winner_batch, (-1, 1))
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Fast rollouts for pure MCTS: a game played out to the end on a compact
+copy of the board, without touching the Board itself.
+
+Uniformly random play is the same as playing the empty locations in a
+random order, so a rollout shuffles them once and then only has to check
+the lines through each new piece for a win, with the rays of the board's
+LineTable. batch_rollout plays many such games at once with array
+operations instead, and heuristic_rollout plays a stronger, less random
+game that makes pure MCTS need far fewer playouts.
+
+A rollout policy is any function of a board that returns the winner of a
+game played out from it, like these three.
+"""
+
+from __future__ import print_function
+import numpy as np
+from game import line_table
+
+# the LineTable of each board size as plain lists, for heuristic_rollout
+_list_tables = {}
+
+
+def random_rollout(board):
+    """Play board out with uniformly random moves, from np.random, and
+    return the winner, or -1 for a tie. The board is left unchanged.
+    """
+    end, winner = board.game_end()
+    if end:
+        return winner
+    n = board.n_in_row
+    rays = line_table(board.width, board.height, n).rays
+    # the player on each location, 0 if empty
+    cells = board._cells.tolist()
+    player = board.current_player
+    p1, p2 = board.players
+    opponent = p1 if player == p2 else p2
+    for move in np.random.permutation(board.availables).tolist():
+        cells[move] = player
+        for forward, backward in rays[move]:
+            count = 1
+            for m in forward:
+                if cells[m] != player:
+                    break
+                count += 1
+            for m in backward:
+                if cells[m] != player:
+                    break
+                count += 1
+            if count >= n:
+                return player
+        player, opponent = opponent, player
+    return -1
+
+
+def batch_rollout(board, n_rollouts):
+    """Play board out n_rollouts times with uniformly random moves, from
+    np.random, all at once. Return an int array of the winners, -1 for a
+    tie. The board is left unchanged.
+
+    Every game fills the whole board in a random order. A window of the
+    LineTable is won at the time its last piece is placed, if all its
+    pieces are of one player, and the game goes to the window won first:
+    the moves after it would not have been played.
+    """
+    end, winner = board.game_end()
+    if end:
+        return np.full(n_rollouts, winner, dtype=int)
+    size = board.width * board.height
+    windows = line_table(board.width, board.height, board.n_in_row).windows
+    empties = np.array(board.availables, dtype=np.intp)
+    # the order in which each game fills the empty locations
+    ranks = np.random.rand(n_rollouts, len(empties)).argsort(
+        axis=1).argsort(axis=1)
+    # time each location is played at, -1 for the pieces already there
+    times = np.full((n_rollouts, size), -1, dtype=np.intp)
+    times[:, empties] = ranks
+    player = board.current_player
+    p1, p2 = board.players
+    opponent = p1 if player == p2 else p2
+    cells = np.repeat(board._cells[np.newaxis].astype(int), n_rollouts,
+                      axis=0)
+    cells[:, empties] = np.where(ranks % 2 == 0, player, opponent)
+
+    lines = cells[:, windows]
+    won = (lines == lines[:, :, :1]).all(axis=2)
+    # time each window is won at, size if it never is
+    win_times = np.where(won, times[:, windows].max(axis=2), size)
+    first = win_times.argmin(axis=1)
+    games = np.arange(n_rollouts)
+    return np.where(win_times[games, first] < size,
+                    lines[games, first, 0], -1)
+
+
+def _list_table(width, height, n_in_row):
+    """Return (windows, cell_windows, neighbours) of the LineTable as
+    Python lists, which are faster to index one item at a time
+    """
+    key = (width, height, n_in_row)
+    if key not in _list_tables:
+        lines = line_table(width, height, n_in_row)
+        _list_tables[key] = (
+            lines.windows.tolist(),
+            [windows.tolist() for windows in lines.cell_windows],
+            [moves.tolist() for moves in lines.neighbours(1)])
+    return _list_tables[key]
+
+
+def heuristic_rollout(board):
+    """Play board out and return the winner, or -1 for a tie. The board is
+    left unchanged. At every move the player to move:
+        plays a move that wins right away, if there is one,
+        or else blocks a move the opponent would win with,
+        or else plays a random empty location next to a piece, one next
+            to several pieces being more likely,
+        or else, on an empty neighbourhood, any random empty location.
+
+    The pieces of each player in every window are counted and updated
+    with each move, so that a window one piece short of a win, and with
+    none of the opponent's, gives away its last empty location at once.
+    """
+    end, winner = board.game_end()
+    if end:
+        return winner
+    n = board.n_in_row
+    windows, cell_windows, neighbours = _list_table(
+        board.width, board.height, n)
+    cells = board._cells.tolist()
+    p1, p2 = board.players
+    lines = board._cells[line_table(board.width, board.height, n).windows]
+    counts = {p: (lines == p).sum(axis=1).tolist() for p in (p1, p2)}
+    # locations that win for each player, stale once occupied
+    threats = {p1: [], p2: []}
+    for player, opponent in ((p1, p2), (p2, p1)):
+        own, other = counts[player], counts[opponent]
+        for w, window in enumerate(windows):
+            if own[w] == n - 1 and not other[w]:
+                threats[player].extend(m for m in window if not cells[m])
+    # empty locations next to a piece, once for each such piece
+    frontier = [m for move, player in enumerate(cells) if player
+                for m in neighbours[move] if not cells[m]]
+    others = None
+    n_left = len(board.availables)
+    draws = np.random.rand(n_left).tolist()
+    player = board.current_player
+    opponent = p1 if player == p2 else p2
+    for draw in draws:
+        own_threats = threats[player]
+        while own_threats:
+            if not cells[own_threats.pop()]:
+                return player
+        move = None
+        blocks = threats[opponent]
+        while blocks:
+            if not cells[blocks[-1]]:
+                move = blocks[-1]
+                break
+            blocks.pop()
+        while move is None and frontier:
+            i = int(draw * len(frontier))
+            if not cells[frontier[i]]:
+                move = frontier[i]
+            else:
+                frontier[i] = frontier[-1]
+                frontier.pop()
+        if move is None:
+            if others is None:
+                others = np.random.permutation(board.availables).tolist()
+            while cells[others[-1]]:
+                others.pop()
+            move = others[-1]
+
+        cells[move] = player
+        own, other = counts[player], counts[opponent]
+        for w in cell_windows[move]:
+            own[w] += 1
+            if own[w] == n - 1 and not other[w]:
+                threats[player].extend(m for m in windows[w] if not cells[m])
+        frontier.extend(m for m in neighbours[move] if not cells[m])
+        player, opponent = opponent, player
+    return -1
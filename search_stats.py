@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of the tree search: where the time of a move goes,
+phase by phase, and the shape of the tree it leaves behind.
+
+An engine built with stats=SearchStats() times the phases of each
+sequential playout and records every search. The playout marks the end of
+each phase with a tick function: SearchStats.tick, or no_tick with the
+default stats=None, so that the playouts run without a single timer call.
+"""
+
+from __future__ import print_function
+import json
+import time
+import numpy as np
+
+# phases of a playout, in the order they run
+PHASES = ('select', 'game_end', 'inference', 'rollout', 'expand', 'backup',
+          'prune', 'copy')
+
+
+class SearchStats(object):
+    """Cumulative statistics over the searches of one engine.
+
+    Phase times and leaf depths are summed over all the playouts,
+    pondering included; 'copy' is the clone of the board made once per
+    search. The latencies
+    are kept per search, for the percentiles.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phase_time = dict.fromkeys(PHASES, 0.0)
+        self.n_playout = 0
+        self.n_search = 0
+        self.search_time = 0.0
+        self.latencies = []
+        self.max_depth = 0
+        self._depth_sum = 0
+        # playouts whose depth was recorded, ponder playouts included
+        self._n_depth = 0
+        # shape of the tree after the last search
+        self.tree_size = 0
+        self.branching = 0.0
+        self._last_tick = time.perf_counter()
+
+    def add(self, phase, seconds):
+        self.phase_time[phase] += seconds
+
+    def tick(self, phase=None, depth=None):
+        """Add the time since the last tick to phase. A tick without a
+        phase starts the clock of a playout, and depth, given with the
+        select phase, is the depth of the leaf the playout reached.
+        """
+        now = time.perf_counter()
+        if phase is not None:
+            self.phase_time[phase] += now - self._last_tick
+        if depth is not None:
+            self.add_depth(depth)
+        self._last_tick = now
+
+    def add_depth(self, depth):
+        """Record the depth of the leaf reached by one playout"""
+        self._depth_sum += depth
+        self._n_depth += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def end_search(self, n_playout, seconds, root):
+        """Record a finished search of n_playout playouts and the tree under
+        root. Walking the tree costs a pass over its nodes, paid only when
+        the stats are on.
+        """
+        self.n_search += 1
+        self.n_playout += n_playout
+        self.search_time += seconds
+        self.latencies.append(seconds)
+        n_nodes = 0
+        n_expanded = 0
+        n_children = 0
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            n_nodes += 1
+            if node._child_nodes:
+                n_expanded += 1
+                n_children += len(node._child_nodes)
+                stack.extend(node._child_nodes)
+        self.tree_size = n_nodes
+        self.branching = float(n_children) / n_expanded if n_expanded else 0.0
+
+    def percentile(self, q):
+        """Return the q-th percentile of the search latencies, in seconds"""
+        if not self.latencies:
+            return 0.0
+        return float(np.percentile(self.latencies, q))
+
+    def summary(self):
+        """Return the statistics as a dict of plain numbers"""
+        return {
+            'n_search': self.n_search,
+            'n_playout': self.n_playout,
+            'playouts_per_sec': (self.n_playout / self.search_time
+                                 if self.search_time else 0.0),
+            'phase_time': dict(self.phase_time),
+            'tree_size': self.tree_size,
+            'max_depth': self.max_depth,
+            'mean_depth': (float(self._depth_sum) / self._n_depth
+                           if self._n_depth else 0.0),
+            'branching': self.branching,
+            'latency_p50': self.percentile(50),
+            'latency_p95': self.percentile(95),
+            'latency_p99': self.percentile(99),
+        }
+
+    def to_json(self, path=None):
+        """Return the summary as JSON, and write it to path if given"""
+        text = json.dumps(self.summary(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def __str__(self):
+        info = self.summary()
+        phase_time = info['phase_time']
+        phases = ', '.join('{}:{:.3f}s'.format(phase, phase_time[phase])
+                           for phase in PHASES if phase_time[phase])
+        return ("SearchStats(playouts/sec:{:.0f}, tree:{}, depth:{}, "
+                "branching:{:.2f}, p50/p95/p99:{:.0f}/{:.0f}/{:.0f}ms, {})"
+                .format(info['playouts_per_sec'], info['tree_size'],
+                        info['max_depth'], info['branching'],
+                        info['latency_p50'] * 1000,
+                        info['latency_p95'] * 1000,
+                        info['latency_p99'] * 1000, phases))
+
+
+def no_tick(phase=None, depth=None):
+    """SearchStats.tick for an engine without stats"""
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+The solver proves nodes from the terminal positions the search finds, and
+a tree budget collapses the least visited subtrees back into leaves. A
+proven node must keep the moves that prove it, so that the search can go
+on after update_with_move makes it the root.
+
+Usage: python -m pytest test_mcts_solver.py
+"""
+
+from __future__ import print_function
+from game import Board
+import mcts_alphaZero
+from test_mcts_undo import policy_value_fn
+
+# an 8x8 game, 5 in a row, with few moves left and many of them proven
+_OPENING = [44, 28, 55, 3, 30, 53, 18, 9, 7, 25, 43, 4, 29, 40, 31, 35,
+            57, 58, 5, 48, 10, 21, 47, 46, 6, 17, 14, 13, 49, 32, 12, 61,
+            60, 11, 16, 50, 23, 39, 33, 8, 52, 36, 22, 38, 37, 51, 27, 42,
+            24, 0, 20, 63]
+
+
+def test_pruned_tree_keeps_proven_roots_searchable():
+    board = Board(width=8, height=8, n_in_row=5)
+    board.init_board()
+    for move in _OPENING:
+        board.do_move(move)
+    mcts = mcts_alphaZero.MCTS(policy_value_fn, 5, 1000, max_nodes=300)
+    while not board.game_end()[0]:
+        acts, probs = mcts.get_move_probs(board)
+        assert len(acts) == len(board.availables)
+        move = acts[int(probs.argmax())]
+        board.do_move(move)
+        mcts.update_with_move(move)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+The MCTS engines clone the board once per search and unwind each playout
+with undo_move. Under a fixed seed they must visit the tree exactly as
+the search that deep-copied the board for every playout.
+
+Usage: python -m pytest test_mcts_undo.py
+"""
+
+from __future__ import print_function
+import copy
+import numpy as np
+import pytest
+from game import Board, BitBoard
+import mcts_alphaZero
+import mcts_pure
+
+# fixed random weights of every move, for a deterministic policy
+_WEIGHTS = np.random.RandomState(0).rand(8 * 8)
+
+
+def policy_value_fn(board):
+    probs = _WEIGHTS[board.availables]
+    probs /= probs.sum()
+    value = (board.zobrist_hash() % 2001) / 1000.0 - 1.0
+    return zip(board.availables, probs), value
+
+
+def deepcopy_search(mcts, state, n_playout):
+    """The search as it was before undo_move: a deep copy of the board for
+    every playout
+    """
+    for n in range(n_playout):
+        mcts._playout(copy.deepcopy(state))
+
+
+def make_board(board_cls):
+    board = board_cls(width=8, height=8, n_in_row=5)
+    board.init_board()
+    for move in (27, 36, 28, 35, 19):
+        board.do_move(move)
+    return board
+
+
+def root_visits(mcts):
+    return sorted((act, node._n_visits)
+                  for act, node in mcts._root._children.items())
+
+
+@pytest.mark.parametrize('board_cls', [Board, BitBoard])
+def test_alphazero_undo_matches_deepcopy(board_cls):
+    n_playout = 300
+    board = make_board(board_cls)
+    undo = mcts_alphaZero.MCTS(policy_value_fn, 5, n_playout)
+    undo.get_move_probs(board)
+    reference = mcts_alphaZero.MCTS(policy_value_fn, 5, n_playout)
+    deepcopy_search(reference, board, n_playout)
+    assert root_visits(undo) == root_visits(reference)
+
+
+@pytest.mark.parametrize('board_cls', [Board, BitBoard])
+def test_pure_undo_matches_deepcopy(board_cls):
+    n_playout = 300
+    board = make_board(board_cls)
+    np.random.seed(0)
+    undo = mcts_pure.MCTS(mcts_pure.policy_value_fn, 5, n_playout)
+    undo.get_move(board)
+    np.random.seed(0)
+    reference = mcts_pure.MCTS(mcts_pure.policy_value_fn, 5, n_playout)
+    deepcopy_search(reference, board, n_playout)
+    assert root_visits(undo) == root_visits(reference)
+
+
+@pytest.mark.parametrize('board_cls', [Board, BitBoard])
+def test_search_leaves_board_unchanged(board_cls):
+    board = make_board(board_cls)
+    before = (sorted(board.availables), dict(board.states),
+              board.current_player, board.last_move, board.zobrist_hash())
+    mcts_alphaZero.MCTS(policy_value_fn, 5, 200).get_move_probs(board)
+    mcts_pure.MCTS(mcts_pure.policy_value_fn, 5, 200).get_move(board)
+    assert before == (sorted(board.availables), dict(board.states),
+                      board.current_player, board.last_move,
+                      board.zobrist_hash())
@@ -10,7 +10,10 @@ import random
 import numpy as np
 from collections import defaultdict, deque
 from game import Board, Game
+from game_record import GameRecord, write_records
+from eval_cache import EvalCache
 from mcts_pure import MCTSPlayer as MCTS_Pure
+from rollout import random_rollout
 from mcts_alphaZero import MCTSPlayer
 from policy_value_net import PolicyValueNet  # Theano and Lasagne
 # from policy_value_net_pytorch import PolicyValueNet  # Pytorch
@@ -33,7 +36,19 @@ class TrainPipeline():
         self.lr_multiplier = 1.0  # adaptively adjust the learning rate based on KL
         self.temp = 1.0  # the temperature param
         self.n_playout = 400  # num of simulations for each move
+        # playout cap randomization: the share of self-play moves that get
+        # the full n_playout search and a policy target, the others get
+        # n_playout_fast playouts and only train the value
+        self.full_search_prob = 1.0
+        self.n_playout_fast = 100
         self.c_puct = 5
+        # leaves evaluated together in one network call during self-play
+        self.n_parallel = 1
+        # memory budget of the self-play search tree, in bytes (None: no
+        # limit); the least visited subtrees are pruned to stay under it
+        self.max_tree_bytes = None
+        # network evaluations kept across searches, cleared on every update
+        self.eval_cache_size = 100000
         self.buffer_size = 10000
         self.batch_size = 512  # mini-batch size for training
         self.data_buffer = deque(maxlen=self.buffer_size)
@@ -46,6 +61,14 @@ class TrainPipeline():
         # num of simulations used for the pure mcts, which is used as
         # the opponent to evaluate the trained policy
         self.pure_mcts_playout_num = 1000
+        # how the pure MCTS opponent plays its leaves out, e.g.
+        # rollout.heuristic_rollout for a strong opponent at fewer playouts
+        self.pure_mcts_rollout_policy = random_rollout
+        # append every self-play game to this file in the compact
+        # game_record format if set, tagged with the number of policy
+        # updates done so far as the model id
+        self.record_path = None
+        self.n_updates = 0
         if init_model:
             # start training from an initial policy-value net
             self.policy_value_net = PolicyValueNet(self.board_width,
@@ -55,17 +78,27 @@ class TrainPipeline():
             # start training from a new policy-value net
             self.policy_value_net = PolicyValueNet(self.board_width,
                                                    self.board_height)
-        self.mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
+        self.eval_cache = EvalCache(
+            self.policy_value_net.policy_value_fn, self.eval_cache_size,
+            self.policy_value_net.policy_value_batch_fn)
+        self.mcts_player = MCTSPlayer(self.eval_cache,
                                       c_puct=self.c_puct,
                                       n_playout=self.n_playout,
-                                      is_selfplay=1)
+                                      is_selfplay=1,
+                                      n_parallel=self.n_parallel,
+                                      policy_value_batch_fn=(
+                                          self.eval_cache.
+                                          policy_value_batch_fn),
+                                      max_bytes=self.max_tree_bytes,
+                                      full_search_prob=self.full_search_prob,
+                                      n_playout_fast=self.n_playout_fast)
 
     def get_equi_data(self, play_data):
         """augment the data set by rotation and flipping
-        play_data: [(state, mcts_prob, winner_z), ..., ...]
+        play_data: [(state, mcts_prob, winner_z, full_search), ..., ...]
         """
         extend_data = []
-        for state, mcts_prob, winner in play_data:
+        for state, mcts_prob, winner, full_search in play_data:
             for i in [1, 2, 3, 4]:
                 # rotate counterclockwise
                 equi_state = np.array([np.rot90(s, i) for s in state])
@@ -73,20 +106,28 @@ class TrainPipeline():
                     mcts_prob.reshape(self.board_height, self.board_width)), i)
                 extend_data.append((equi_state,
                                     np.flipud(equi_mcts_prob).flatten(),
-                                    winner))
+                                    winner, full_search))
                 # flip horizontally
                 equi_state = np.array([np.fliplr(s) for s in equi_state])
                 equi_mcts_prob = np.fliplr(equi_mcts_prob)
                 extend_data.append((equi_state,
                                     np.flipud(equi_mcts_prob).flatten(),
-                                    winner))
+                                    winner, full_search))
         return extend_data
 
     def collect_selfplay_data(self, n_games=1):
         """collect self-play data for training"""
         for i in range(n_games):
+            record = None
+            if self.record_path:
+                record = GameRecord(self.board_width, self.board_height,
+                                    self.n_in_row,
+                                    model_id=str(self.n_updates))
             winner, play_data = self.game.start_self_play(self.mcts_player,
-                                                          temp=self.temp)
+                                                          temp=self.temp,
+                                                          record=record)
+            if record is not None:
+                write_records(self.record_path, [record])
             play_data = list(play_data)[:]
             self.episode_len = len(play_data)
             # augment the data
@@ -100,6 +141,12 @@ class TrainPipeline():
         mcts_probs_batch = [data[1] for data in mini_batch]
         winner_batch = [data[2] for data in mini_batch]
         old_probs, old_v = self.policy_value_net.policy_value(state_batch)
+        # moves from a fast search train the value only: their policy
+        # target is the network's policy as it is before each step, which
+        # leaves the policy loss without gradient on them
+        fast = [i for i, data in enumerate(mini_batch) if not data[3]]
+        for i in fast:
+            mcts_probs_batch[i] = old_probs[i]
         for i in range(self.epochs):
             loss, entropy = self.policy_value_net.train_step(
                     state_batch,
@@ -107,12 +154,17 @@ class TrainPipeline():
                     winner_batch,
                     self.learn_rate*self.lr_multiplier)
             new_probs, new_v = self.policy_value_net.policy_value(state_batch)
+            for j in fast:
+                mcts_probs_batch[j] = new_probs[j]
             kl = np.mean(np.sum(old_probs * (
                     np.log(old_probs + 1e-10) - np.log(new_probs + 1e-10)),
                     axis=1)
             )
             if kl > self.kl_targ * 4:  # early stopping if D_KL diverges badly
                 break
+        self.n_updates += 1
+        # the cached evaluations are from the old network
+        self.eval_cache.clear()
         # adaptively adjust the learning rate
         if kl > self.kl_targ * 2 and self.lr_multiplier > 0.1:
             self.lr_multiplier /= 1.5
@@ -144,11 +196,12 @@ class TrainPipeline():
         Evaluate the trained policy by playing against the pure MCTS player
         Note: this is only for monitoring the progress of training
         """
-        current_mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
+        current_mcts_player = MCTSPlayer(self.eval_cache,
                                          c_puct=self.c_puct,
                                          n_playout=self.n_playout)
-        pure_mcts_player = MCTS_Pure(c_puct=5,
-                                     n_playout=self.pure_mcts_playout_num)
+        pure_mcts_player = MCTS_Pure(
+            c_puct=5, n_playout=self.pure_mcts_playout_num,
+            rollout_policy=self.pure_mcts_rollout_policy)
         win_cnt = defaultdict(int)
         for i in range(n_games):
             winner = self.game.start_play(current_mcts_player,
@@ -160,6 +213,7 @@ class TrainPipeline():
         print("num_playouts:{}, win: {}, lose: {}, tie:{}".format(
                 self.pure_mcts_playout_num,
                 win_cnt[1], win_cnt[2], win_cnt[-1]))
+        print(self.eval_cache)
         return win_ratio
 
     def run(self):